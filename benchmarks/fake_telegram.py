@@ -0,0 +1,151 @@
+# benchmarks/fake_telegram.py
+"""
+Локальная имитация Telegram для бенчмарков: клиент Telethon с настраиваемой
+задержкой, случайными FloodWait и синтетическими диалогами, а также сессия
+aiogram, отвечающая на запросы Bot API без сети.
+"""
+import asyncio
+import itertools
+import random
+import re
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message
+from telethon import errors
+from telethon.tl.functions.channels import GetParticipantRequest
+
+import scheduler
+
+
+class FakeBackend:
+    """Общие настройки и счетчики для всех фейковых клиентов."""
+
+    def __init__(self, latency: float = 0.02, flood_rate: float = 0.0, flood_seconds: int = 1,
+                 dialogs: int = 100, seed: int = 0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.dialogs = dialogs
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.floods = 0
+
+    async def rpc(self, method: str, can_flood: bool = True):
+        """Имитация сетевого вызова: задержка и, с вероятностью flood_rate, FloodWait."""
+        self.calls[method] += 1
+        await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if can_flood and self.flood_rate and self.random.random() < self.flood_rate:
+            self.floods += 1
+            raise errors.FloodWaitError(request=None, capture=self.flood_seconds)
+
+
+class FakeTelegramClient:
+    """Подмножество TelegramClient, которое используют utils.py и index.py."""
+
+    def __init__(self, backend: FakeBackend, user_id: int):
+        self.backend = backend
+        self.user_id = user_id
+        self.session = SimpleNamespace(save=lambda: f"fake-session-{user_id}")
+        self._connected = False
+
+    async def connect(self):
+        await self.backend.rpc("connect", can_flood=False)
+        self._connected = True
+
+    async def disconnect(self):
+        self._connected = False
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def is_user_authorized(self) -> bool:
+        await self.backend.rpc("is_user_authorized", can_flood=False)
+        return True
+
+    async def get_me(self):
+        await self.backend.rpc("get_me", can_flood=False)
+        return SimpleNamespace(id=self.user_id, first_name="Bench", username=f"bench{self.user_id}")
+
+    async def get_entity(self, entity):
+        await self.backend.rpc("get_entity")
+        return SimpleNamespace(id=abs(hash(entity)) % 10 ** 9, title=str(entity))
+
+    async def send_message(self, entity, message, **kwargs):
+        await self.backend.rpc("send_message")
+        return SimpleNamespace(id=self.backend.calls["send_message"], media=None)
+
+    async def __call__(self, request):
+        await self.backend.rpc(type(request).__name__)
+        if isinstance(request, GetParticipantRequest):
+            raise errors.UserNotParticipantError(request=None)
+        return SimpleNamespace(chats=[])
+
+    async def iter_dialogs(self):
+        # Как и Telethon, отдаем диалоги страницами по 100 с задержкой на страницу
+        for start in range(0, self.backend.dialogs, 100):
+            await self.backend.rpc("GetDialogsRequest")
+            for chat_id in range(start, min(start + 100, self.backend.dialogs)):
+                entity = SimpleNamespace(id=1_000_000 + chat_id, title=f"Синтетический чат {chat_id}")
+                yield SimpleNamespace(entity=entity)
+
+
+def fake_connect(backend: FakeBackend):
+    """Замена utils._connect_client: пул клиентов и планировщик остаются в работе."""
+    async def _connect_client(user_id: int, api_id: int, api_hash: str, session_string):
+        client = FakeTelegramClient(backend, user_id)
+        scheduler.bind(client, user_id)
+        await client.connect()
+        if not await client.is_user_authorized():
+            return client, None
+        return client, await client.get_me()
+    return _connect_client
+
+
+class FakeBotSession(BaseSession):
+    """
+    Сессия aiogram без сети: любой метод Bot API успешно выполняется,
+    отправленные сообщения запоминаются, а номера фоновых задач из текстов
+    ответов позволяют дождаться их завершения.
+    """
+
+    ENQUEUED = re.compile(r"Задача #(\d+):")
+    FINISHED = re.compile(r"^(?:✅|❌) Задача #(\d+)")
+
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self.last_enqueued: dict[int, int] = {}  # chat_id -> номер последней поставленной задачи
+        self._finished: dict[int, asyncio.Future] = {}
+
+    def job_future(self, job_id: int) -> asyncio.Future:
+        future = self._finished.get(job_id)
+        if future is None:
+            future = self._finished[job_id] = asyncio.get_running_loop().create_future()
+        return future
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        text = getattr(method, "text", None)
+        chat_id = getattr(method, "chat_id", None)
+        if text:
+            if match := self.FINISHED.search(text):
+                future = self.job_future(int(match.group(1)))
+                if not future.done():
+                    future.set_result(text)
+            elif match := self.ENQUEUED.search(text):
+                self.last_enqueued[chat_id] = int(match.group(1))
+        if type(method).__name__ in ("SendMessage", "SendDocument"):
+            return Message(message_id=next(self._message_ids), date=datetime.now(),
+                           chat=Chat(id=chat_id, type="private"), text=text)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        if False:
+            yield b""
+
+    async def close(self):
+        pass
@@ -0,0 +1,67 @@
+# benchmarks/log_writer.py
+"""
+Сравнение скорости записи логов: старый log_event (INSERT + commit на каждое
+событие) против буферизованного LogWriter с групповым коммитом.
+
+Запуск из корня проекта:
+    python benchmarks/log_writer.py --events 2000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database
+
+
+def bench_commit_per_event(path: str, events: int) -> float:
+    """Поведение до LogWriter: журнал по умолчанию, commit на каждое событие."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE logs (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "timestamp INTEGER NOT NULL, event_type TEXT NOT NULL, message TEXT NOT NULL)"
+    )
+    conn.commit()
+    start = time.perf_counter()
+    for i in range(events):
+        conn.execute(
+            "INSERT INTO logs (timestamp, event_type, message) VALUES (?, ?, ?)",
+            (int(time.time()), "BENCH", f"event {i}")
+        )
+        conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return events / elapsed
+
+
+def bench_log_writer(path: str, events: int, synchronous: str) -> float:
+    """LogWriter: WAL, групповой коммит, замер до полной записи на диск."""
+    db = Database(path, synchronous=synchronous)
+    start = time.perf_counter()
+    for i in range(events):
+        db.log_event("BENCH", f"event {i}")
+    db.log_writer.flush()
+    elapsed = time.perf_counter() - start
+    db.close()
+    return events / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before = bench_commit_per_event(os.path.join(tmp, "before.db"), args.events)
+        print(f"commit на событие:          {before:12.0f} событий/с")
+        for level in ("NORMAL", "FULL"):
+            after = bench_log_writer(os.path.join(tmp, f"after_{level}.db"), args.events, level)
+            print(f"LogWriter (WAL, {level:6}):   {after:12.0f} событий/с  (x{after / before:.1f})")
+
+
+if __name__ == "__main__":
+    main()
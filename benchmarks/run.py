@@ -0,0 +1,248 @@
+# benchmarks/run.py
+"""
+Нагрузочные замеры бота без Telegram: фейковый клиент Telethon (задержка,
+FloodWait, синтетические диалоги) вместо реального подключения и синтетические
+апдейты, которые проходят через Dispatcher и обработчики index.py.
+
+Сценарии: /send, /join, /scan (10k диалогов, полный и инкрементальный),
+/listchats с листанием страниц и операции Database. Для каждого - пропускная
+способность и задержки p50/p99; результаты пишутся в JSON для сравнения.
+
+Запуск из корня проекта:
+    python benchmarks/run.py --out bench_results.json
+    python benchmarks/run.py --latency 0.05 --flood-rate 0.01 --compare bench_results.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_USER_ID = 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.02, help="средняя задержка вызова Telegram, с")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля вызовов, получающих FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="длительность FloodWait, с")
+    parser.add_argument("--dialogs", type=int, default=10_000, help="диалогов у аккаунта для /scan")
+    parser.add_argument("--requests", type=int, default=200, help="команд в сценариях /send, /join, /listchats")
+    parser.add_argument("--concurrency", type=int, default=20, help="одновременных апдейтов")
+    parser.add_argument("--db-ops", type=int, default=2000, help="операций в сценариях Database")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_results.json", help="куда записать результаты")
+    parser.add_argument("--compare", help="JSON предыдущего запуска для сравнения")
+    return parser.parse_args()
+
+
+def prepare_environment(args, workdir: str):
+    """Окружение до импорта index: фиктивный токен, снятые лимиты, временная база."""
+    os.environ.setdefault("BOT_TOKEN", "42:BENCHMARK")
+    for op in ("JOIN", "SEND"):
+        os.environ[f"USERBOT_RATE_{op}_PER_MIN"] = "1000000"
+        os.environ[f"USERBOT_RATE_{op}_BURST"] = "1000"
+    os.environ["USERBOT_LOG_RETENTION_DAYS"] = "0"
+    os.chdir(workdir)  # userbot.db создается в текущем каталоге
+
+
+def summarize(latencies: list, elapsed: float) -> dict:
+    """Пропускная способность и перцентили задержки в миллисекундах."""
+    ordered = sorted(latencies)
+
+    def percentile(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000 if ordered else 0.0
+
+    return {
+        "count": len(ordered),
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(0.50), 3),
+        "p99_ms": round(percentile(0.99), 3),
+    }
+
+
+async def measure(calls, concurrency: int) -> dict:
+    """Выполнить корутины-фабрики calls не более чем по concurrency одновременно."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(call):
+        async with semaphore:
+            started = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(call) for call in calls))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+class Driver:
+    """Отправка синтетических апдейтов в Dispatcher."""
+
+    def __init__(self, index, session):
+        from aiogram.types import CallbackQuery, Chat, Message, Update, User
+        self.index = index
+        self.session = session
+        self._types = (CallbackQuery, Chat, Message, Update, User)
+        self._ids = itertools.count(1)
+        self._chats = itertools.count(10_000)  # у каждой команды свой чат, чтобы различать ответы
+
+    def _message(self, text: str, chat_id: int):
+        CallbackQuery, Chat, Message, Update, User = self._types
+        return Message(message_id=next(self._ids), date=datetime.now(), text=text,
+                       chat=Chat(id=chat_id, type="private"),
+                       from_user=User(id=BENCH_USER_ID, is_bot=False, first_name="Bench"))
+
+    async def command(self, text: str) -> int:
+        """Отправить команду; возвращает id чата, в который пришел ответ."""
+        CallbackQuery, Chat, Message, Update, User = self._types
+        chat_id = next(self._chats)
+        update = Update(update_id=next(self._ids), message=self._message(text, chat_id))
+        await self.index.dp.feed_update(self.index.bot, update)
+        return chat_id
+
+    async def job(self, text: str) -> str:
+        """Отправить команду, ставящую задачу, и дождаться ее результата."""
+        chat_id = await self.command(text)
+        job_id = self.session.last_enqueued.pop(chat_id)
+        return await self.session.job_future(job_id)
+
+    async def callback(self, data: str):
+        CallbackQuery, Chat, Message, Update, User = self._types
+        message = self._message("", BENCH_USER_ID)
+        query = CallbackQuery(id=str(next(self._ids)), chat_instance="bench", data=data,
+                              from_user=message.from_user, message=message)
+        await self.index.dp.feed_update(self.index.bot, Update(update_id=next(self._ids), callback_query=query))
+
+
+async def bench_db(db, ops: int) -> dict:
+    results = {}
+    results["db.log_event"] = await measure(
+        [lambda i=i: db.log_event("BENCH", f"событие {i}", user_id=BENCH_USER_ID, outcome="ok") for i in range(ops)],
+        concurrency=1)
+    results["db.get_logs_page"] = await measure(
+        [lambda: db.get_logs_page(BENCH_USER_ID, limit=15) for _ in range(ops // 10)], concurrency=1)
+    results["db.get_chats_page"] = await measure(
+        [lambda: db.get_chats_page(limit=30) for _ in range(ops // 10)], concurrency=1)
+    results["db.find_chats"] = await measure(
+        [lambda i=i: db.find_chats(f"чат {i}", limit=20) for i in range(ops // 10)], concurrency=1)
+    results["db.get_session"] = await measure(
+        [lambda: db.get_session(BENCH_USER_ID) for _ in range(ops)], concurrency=1)
+    return results
+
+
+async def run(args) -> dict:
+    import index
+    import utils
+    from fake_telegram import FakeBackend, FakeBotSession, fake_connect
+
+    logging.getLogger().setLevel(logging.ERROR)
+    backend = FakeBackend(latency=args.latency, flood_rate=args.flood_rate, flood_seconds=args.flood_seconds,
+                          dialogs=args.dialogs, seed=args.seed)
+    session = FakeBotSession()
+    index.bot.session = session
+    utils._connect_client = fake_connect(backend)
+    driver = Driver(index, session)
+
+    await index.db.save_session(BENCH_USER_ID, 1, "bench", "fake-session")
+    await index.jobs.start()
+    results = {}
+    try:
+        # /scan: сначала полный, затем инкрементальный по уже сохраненным чатам
+        for mode in ("full", "incremental"):
+            started = time.perf_counter()
+            await driver.job("/scan full" if mode == "full" else "/scan")
+            elapsed = time.perf_counter() - started
+            results[f"scan.{mode}"] = summarize([elapsed], elapsed)
+            results[f"scan.{mode}"]["dialogs_per_second"] = round(args.dialogs / elapsed, 1)
+
+        results["send"] = await measure(
+            [lambda i=i: driver.job(f"/send {-100 - i} сообщение {i}") for i in range(args.requests)],
+            args.concurrency)
+        results["join"] = await measure(
+            [lambda i=i: driver.job(f"/join https://t.me/bench_channel_{i}") for i in range(args.requests)],
+            args.concurrency)
+        # Повторные вступления в те же чаты отвечают из кэша участия
+        results["join.repeat"] = await measure(
+            [lambda i=i: driver.job(f"/join @bench_channel_{i}") for i in range(args.requests)],
+            args.concurrency)
+        results["listchats"] = await measure(
+            [lambda: driver.command("/listchats") for _ in range(args.requests)], args.concurrency)
+        first_id = 1_000_000
+        results["listchats.next_page"] = await measure(
+            [lambda i=i: driver.callback(f"lc:n:{first_id + i * 30}:-:") for i in range(args.requests)],
+            args.concurrency)
+        results.update(await bench_db(index.db, args.db_ops))
+    finally:
+        await index.jobs.stop()
+        await utils.userbot_pool.close()
+        await index.db.close()
+
+    results["_backend"] = {"calls": dict(backend.calls), "flood_waits": backend.floods,
+                           "bot_api_calls": dict(session.calls)}
+    return results
+
+
+def compare(old: dict, new: dict):
+    """Таблица изменений пропускной способности и p99 относительно прошлого запуска."""
+    print(f"\n{'сценарий':24} {'throughput':>22} {'p99, мс':>24}")
+    for name, current in new["results"].items():
+        previous = old.get("results", {}).get(name)
+        if name.startswith("_") or previous is None:
+            continue
+
+        def delta(key):
+            before, after = previous[key], current[key]
+            change = (after - before) / before * 100 if before else 0.0
+            return f"{before:9.1f} -> {after:9.1f} ({change:+6.1f}%)"
+
+        print(f"{name:24} {delta('throughput'):>22} {delta('p99_ms'):>24}")
+
+
+def main():
+    args = parse_args()
+    out_path = os.path.abspath(args.out)
+    old = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            old = json.load(f)
+    with tempfile.TemporaryDirectory() as workdir:
+        prepare_environment(args, workdir)
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            os.chdir(ROOT)
+
+    report = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        },
+        "results": results,
+    }
+    for name, row in results.items():
+        if not name.startswith("_"):
+            print(f"{name:24} {row['throughput']:10.1f} оп/с   p50 {row['p50_ms']:8.2f} мс   p99 {row['p99_ms']:8.2f} мс")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты записаны в {out_path}")
+    if old is not None:
+        compare(old, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,176 @@
 # db.py
+import asyncio
+import functools
+import logging
+import os
+import pathlib
 import sqlite3
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Параметры журнала SQLite и буфера логов (можно переопределить переменными окружения)
+DB_JOURNAL_MODE = os.getenv("USERBOT_DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.getenv("USERBOT_DB_SYNCHRONOUS", "NORMAL")  # OFF / NORMAL / FULL / EXTRA
+LOG_FLUSH_EVENTS = int(os.getenv("USERBOT_LOG_FLUSH_EVENTS", "200"))
+LOG_FLUSH_INTERVAL_MS = int(os.getenv("USERBOT_LOG_FLUSH_INTERVAL_MS", "500"))
+LOG_EXPORT_CHUNK_ROWS = 5000  # строк логов на одну пачку выгрузки
+
+# Состояния сессии UserBot в sessions.status
+SESSION_STATUSES = (
+    "unknown",       # еще не проверялась
+    "ok",            # подключена и авторизована
+    "unauthorized",  # сессия больше не авторизована (ключ отозван или истек), нужен /login
+    "banned",        # аккаунт заблокирован или удален
+    "flood",         # аккаунт ждет окончания FloodWait
+    "error",         # не удалось подключиться (сеть и т.п.), проверяется снова
+)
+
+
+class LogWriter:
+    """
+    Буферизованная запись логов с групповым коммитом.
+    События копятся в памяти и записываются одним executemany в одной
+    транзакции, как только набралось flush_events событий или самое старое
+    событие ждет дольше flush_interval_ms — что наступит раньше.
+
+    Гарантии сохранности:
+    - события в буфере (не более flush_events штук за последние
+      flush_interval_ms) теряются при аварийном завершении процесса;
+    - при штатной остановке close() записывает весь буфер;
+    - записанная пачка при journal_mode=WAL и synchronous=NORMAL переживает
+      падение процесса, но последние коммиты могут откатиться при отключении
+      питания или падении ОС; synchronous=FULL убирает и этот риск ценой fsync
+      на каждый коммит.
+    """
+    INSERT_SQL = (
+        "INSERT INTO logs (timestamp, event_type, message, user_id, chat_id, outcome) "
+        "VALUES (?, ?, ?, ?, ?, ?)"
+    )
+
+    def __init__(self, conn: sqlite3.Connection, lock: threading.Lock,
+                 flush_events: int = LOG_FLUSH_EVENTS, flush_interval_ms: int = LOG_FLUSH_INTERVAL_MS):
+        self.conn = conn
+        self.lock = lock
+        self.flush_events = max(1, flush_events)
+        self.flush_interval = flush_interval_ms / 1000
+        self._buffer = []
+        self._first_at = 0.0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, row: tuple):
+        """Поставить событие в очередь на запись."""
+        with self._cond:
+            if not self._buffer:
+                self._first_at = time.monotonic()
+            self._buffer.append(row)
+            # Будим поток на первом событии (старт таймера) и при заполнении пачки
+            if len(self._buffer) == 1 or len(self._buffer) >= self.flush_events:
+                self._cond.notify()
+
+    def flush(self):
+        """Синхронно записать все накопленные события."""
+        with self._cond:
+            batch, self._buffer = self._buffer, []
+        self._write(batch)
+
+    def close(self):
+        """Остановить фоновый поток, предварительно записав буфер."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                deadline = self._first_at + self.flush_interval
+                while len(self._buffer) < self.flush_events and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._buffer = self._buffer, []
+                closed = self._closed
+            self._write(batch)
+            if closed:
+                return
+
+    def _write(self, batch: list):
+        if not batch:
+            return
+        try:
+            with self.lock:
+                with self.conn:  # одна транзакция на всю пачку
+                    self.conn.executemany(self.INSERT_SQL, batch)
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось записать {len(batch)} событий в лог: {e}")
+
+
+def _casefold(value):
+    """SQL-функция casefold(): LIKE в SQLite не различает регистр только для ASCII."""
+    return value.casefold() if isinstance(value, str) else value
+
+
+class ChatGraph:
+    """
+    Граф зависимостей чатов в памяти: chat_id -> dependency_chat_id для чатов
+    с зависимостью. Цепочка разрешается за O(длины цепочки) без запросов к БД,
+    а запись зависимости обновляет граф на месте.
+    """
+
+    def __init__(self, rows):
+        self.deps = dict(rows)
+
+    def set(self, chat_id: int, dependency_chat_id):
+        if dependency_chat_id is None:
+            self.deps.pop(chat_id, None)
+        else:
+            self.deps[chat_id] = dependency_chat_id
+
+    def chain(self, chat_id: int) -> list:
+        """
+        Все зависимости чата в порядке отправки: сначала самая глубокая,
+        последней - прямая зависимость chat_id. Сам chat_id не входит.
+        """
+        chain = []
+        seen = {chat_id}
+        dep = self.deps.get(chat_id)
+        while dep is not None and dep not in seen:  # seen - страховка от циклов в старых данных
+            chain.append(dep)
+            seen.add(dep)
+            dep = self.deps.get(dep)
+        chain.reverse()
+        return chain
+
+    def creates_cycle(self, chat_id: int, dependency_chat_id: int) -> bool:
+        """Замкнет ли зависимость chat_id -> dependency_chat_id цикл."""
+        return dependency_chat_id == chat_id or chat_id in self.chain(dependency_chat_id)
+
 
 class Database:
     """Класс для управления базой данных SQLite."""
-    def __init__(self, db_path='userbot.db'):
+    def __init__(self, db_path='userbot.db', synchronous: str = DB_SYNCHRONOUS,
+                 log_flush_events: int = LOG_FLUSH_EVENTS, log_flush_interval_ms: int = LOG_FLUSH_INTERVAL_MS):
+        self.db_path = db_path
         # check_same_thread=False необходимо для работы с асинхронными фреймворками
         self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.lock = threading.Lock()
+        self.conn.create_function("casefold", 1, _casefold, deterministic=True)
+        self.lock = metrics.instrument_lock(threading.Lock())
+        self._chat_graph = None  # ChatGraph, строится при первом обращении
+        self._graph_version = None  # chats_version, при которой построен граф
+        # WAL позволяет читать во время записи, synchronous задает число fsync на коммит
+        self.conn.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+        self.conn.execute(f"PRAGMA synchronous={synchronous}")
         self._init_tables()
+        self.log_writer = LogWriter(self.conn, self.lock, log_flush_events, log_flush_interval_ms)
 
     def _init_tables(self):
         """Инициализация таблиц в базе данных."""
@@ -23,16 +184,46 @@ class Database:
                     user_id INTEGER UNIQUE NOT NULL,
                     api_id INTEGER NOT NULL,
                     api_hash TEXT NOT NULL,
-                    session_string TEXT UNIQUE NOT NULL
+                    session_string TEXT UNIQUE NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'unknown',
+                    status_at INTEGER
                 )
             ''')
+            # Миграция: состояние сессии (SESSION_STATUSES) и время его последней проверки
+            session_columns = {row[1] for row in cursor.execute("PRAGMA table_info(sessions)")}
+            for column, column_type in (("status", "TEXT NOT NULL DEFAULT 'unknown'"), ("status_at", "INTEGER")):
+                if column not in session_columns:
+                    cursor.execute(f"ALTER TABLE sessions ADD COLUMN {column} {column_type}")
             # Таблица для отчетов / логов
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS logs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     timestamp INTEGER NOT NULL,
                     event_type TEXT NOT NULL,
-                    message TEXT NOT NULL
+                    message TEXT NOT NULL,
+                    user_id INTEGER,
+                    chat_id INTEGER,
+                    outcome TEXT
+                )
+            ''')
+            # Миграция логов из старой схемы (только timestamp/event_type/message)
+            log_columns = {row[1] for row in cursor.execute("PRAGMA table_info(logs)")}
+            for column, column_type in (("user_id", "INTEGER"), ("chat_id", "INTEGER"), ("outcome", "TEXT")):
+                if column not in log_columns:
+                    cursor.execute(f"ALTER TABLE logs ADD COLUMN {column} {column_type}")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs (timestamp)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_event_timestamp ON logs (event_type, timestamp)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_timestamp ON logs (user_id, timestamp)")
+            # Архив для старых логов, вытесненных политикой хранения
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS logs_archive (
+                    id INTEGER PRIMARY KEY,
+                    timestamp INTEGER NOT NULL,
+                    event_type TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    user_id INTEGER,
+                    chat_id INTEGER,
+                    outcome TEXT
                 )
             ''')
             # Таблица для чатов и зависимостей
@@ -44,31 +235,323 @@ class Database:
                     UNIQUE(chat_id)
                 )
             ''')
+            # Для постраничного /listchats: фильтр по наличию зависимости и по префиксу названия
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chats_with_dependency ON chats (chat_id) "
+                "WHERE dependency_chat_id IS NOT NULL"
+            )
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_name ON chats (chat_name)")
+            # Версия зависимостей чатов: триггеры увеличивают ее при каждом изменении
+            # dependency_chat_id, по ней граф зависимостей (ChatGraph) узнает о чужих записях
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chats_version (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    version INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute("INSERT OR IGNORE INTO chats_version (id, version) VALUES (0, 0)")
+            for name, event, condition in (
+                ("insert", "INSERT", "NEW.dependency_chat_id IS NOT NULL"),
+                ("delete", "DELETE", "OLD.dependency_chat_id IS NOT NULL"),
+                ("update", "UPDATE OF dependency_chat_id", "OLD.dependency_chat_id IS NOT NEW.dependency_chat_id"),
+            ):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS chats_version_{name} AFTER {event} ON chats
+                    WHEN {condition}
+                    BEGIN
+                        UPDATE chats_version SET version = version + 1;
+                    END
+                ''')
+            self.fts_enabled = self._init_chat_search(cursor)
+            # Снимок последнего /scan для каждого аккаунта: какие чаты, под каким именем
+            # и по какой публичной ссылке (ключ membership.ChatLink) он видел
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scan_snapshot (
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    chat_name TEXT NOT NULL,
+                    scanned_at INTEGER NOT NULL,
+                    link TEXT,
+                    PRIMARY KEY (user_id, chat_id)
+                ) WITHOUT ROWID
+            ''')
+            snapshot_columns = {row[1] for row in cursor.execute("PRAGMA table_info(scan_snapshot)")}
+            if "link" not in snapshot_columns:
+                cursor.execute("ALTER TABLE scan_snapshot ADD COLUMN link TEXT")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_scan_snapshot_link ON scan_snapshot (user_id, link) "
+                "WHERE link IS NOT NULL"
+            )
+            # Время последнего завершенного /scan аккаунта: до него снимок подтверждает участие в чатах
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scan_runs (
+                    user_id INTEGER PRIMARY KEY,
+                    finished_at INTEGER NOT NULL
+                )
+            ''')
+            # Участие аккаунтов в чатах (membership.MembershipCache) и время последнего подтверждения
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS memberships (
+                    account_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    checked_at INTEGER NOT NULL,
+                    PRIMARY KEY (account_id, chat_id)
+                ) WITHOUT ROWID
+            ''')
+            # Куда ведут ссылки: ключ membership.ChatLink (@username или +хэш) -> chat_id
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_links (
+                    link TEXT PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    resolved_at INTEGER NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            # Файлы, уже загруженные аккаунтами (uploads.UploadCache): sha256 содержимого -> ссылка на файл.
+            # used_at (time.time_ns) - последнее использование, по нему вытесняются старые записи
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS uploads (
+                    account_id INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    media_id INTEGER NOT NULL,
+                    access_hash INTEGER NOT NULL,
+                    file_reference BLOB NOT NULL,
+                    used_at INTEGER NOT NULL,
+                    PRIMARY KEY (account_id, sha256, kind)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_uploads_used ON uploads (account_id, used_at)")
+            # Сроки ожидания (FloodWait, медленный режим, антиспам) по аккаунту, чату и операции
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cooldowns (
+                    account_id INTEGER NOT NULL,
+                    chat TEXT NOT NULL,
+                    operation TEXT NOT NULL,
+                    deadline REAL NOT NULL,
+                    PRIMARY KEY (account_id, chat, operation)
+                ) WITHOUT ROWID
+            ''')
+            # Фоновые задачи (jobs.JobQueue): queued -> running -> done / failed
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    result TEXT,
+                    created_at INTEGER NOT NULL,
+                    updated_at INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, id)")
+            # Состояния FSM aiogram (fsm_storage.SQLiteStorage)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS fsm_states (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data BLOB,
+                    updated_at INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated_at)")
+            # Сессии Telethon (tg_session.DbSession): ключ авторизации, кэш сущностей и состояние обновлений.
+            # origin - строка из sessions.session_string, из которой импортирована сессия
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tg_sessions (
+                    account_id INTEGER PRIMARY KEY,
+                    origin TEXT,
+                    dc_id INTEGER NOT NULL,
+                    server_address TEXT,
+                    port INTEGER,
+                    auth_key BLOB
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tg_entities (
+                    account_id INTEGER NOT NULL,
+                    id INTEGER NOT NULL,
+                    hash INTEGER NOT NULL,
+                    username TEXT,
+                    phone TEXT,
+                    name TEXT,
+                    PRIMARY KEY (account_id, id)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tg_update_state (
+                    account_id INTEGER NOT NULL,
+                    entity_id INTEGER NOT NULL,
+                    pts INTEGER, qts INTEGER, date INTEGER, seq INTEGER,
+                    PRIMARY KEY (account_id, entity_id)
+                ) WITHOUT ROWID
+            ''')
             self.conn.commit()
 
-    def log_event(self, event_type: str, message: str):
-        """Запись события в лог."""
+    def _init_chat_search(self, cursor) -> bool:
+        """
+        Полнотекстовый индекс FTS5 (trigram) по chats.chat_name, синхронизируемый триггерами.
+        Trigram ищет подстроки без учета регистра. Если SQLite собран без FTS5,
+        поиск работает через LIKE. Возвращает, доступен ли индекс.
+        """
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chats_fts'"
+        ).fetchone()
+        try:
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5(
+                    chat_name, content='chats', content_rowid='chat_id', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            logging.warning(f"FTS5 недоступен, поиск чатов будет линейным: {e}")
+            return False
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS chats_fts_ai AFTER INSERT ON chats BEGIN
+                INSERT INTO chats_fts (rowid, chat_name) VALUES (new.chat_id, new.chat_name);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS chats_fts_ad AFTER DELETE ON chats BEGIN
+                INSERT INTO chats_fts (chats_fts, rowid, chat_name) VALUES ('delete', old.chat_id, old.chat_name);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS chats_fts_au AFTER UPDATE OF chat_name ON chats BEGIN
+                INSERT INTO chats_fts (chats_fts, rowid, chat_name) VALUES ('delete', old.chat_id, old.chat_name);
+                INSERT INTO chats_fts (rowid, chat_name) VALUES (new.chat_id, new.chat_name);
+            END
+        ''')
+        if not exists:
+            # Индекс создан впервые - заполняем его уже сохраненными чатами
+            cursor.execute("INSERT INTO chats_fts (chats_fts) VALUES ('rebuild')")
+        return True
+
+    def log_event(self, event_type: str, message: str, user_id: int = None,
+                  chat_id: int = None, outcome: str = None):
+        """
+        Запись события в лог (через буфер LogWriter, см. гарантии сохранности там).
+        user_id, chat_id и outcome ("ok"/"fail") хранятся отдельными колонками для выборок.
+        """
+        self.log_writer.write((int(time.time()), event_type, message, user_id, chat_id, outcome))
+
+    def get_logs_page(self, user_id: int = None, event_type: str = None, since: int = None,
+                      before: tuple = None, limit: int = 20):
+        """
+        Страница логов от новых к старым с keyset-пагинацией.
+        before - (timestamp, id) последней строки предыдущей страницы.
+        Возвращает список (id, timestamp, event_type, message, user_id, chat_id, outcome).
+        """
+        # Читатель должен видеть события, еще лежащие в буфере
+        self.log_writer.flush()
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        if event_type is not None:
+            conditions.append("event_type = ?")
+            params.append(event_type)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if before is not None:
+            conditions.append("(timestamp, id) < (?, ?)")
+            params.extend(before)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
         with self.lock:
-            timestamp = int(time.time())
-            self.conn.execute(
-                "INSERT INTO logs (timestamp, event_type, message) VALUES (?, ?, ?)",
-                (timestamp, event_type, message)
+            cursor = self.conn.execute(
+                f"""
+                SELECT id, timestamp, event_type, message, user_id, chat_id, outcome FROM logs
+                {where} ORDER BY timestamp DESC, id DESC LIMIT ?
+                """,
+                (*params, limit)
             )
-            self.conn.commit()
+            return cursor.fetchall()
+
+    def iter_logs(self, user_id: int = None, event_type: str = None, since: int = None,
+                  until: int = None, chunk_rows: int = LOG_EXPORT_CHUNK_ROWS):
+        """
+        Генератор логов по возрастанию (timestamp, id) пачками по chunk_rows строк
+        для выгрузки; until не включается. Читает через отдельное соединение только
+        для чтения: self.lock не берется, а в WAL запись продолжается во время
+        выгрузки (генератор видит снимок на момент первого чтения).
+        Строки: (id, timestamp, event_type, message, user_id, chat_id, outcome).
+        """
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        if event_type is not None:
+            conditions.append("event_type = ?")
+            params.append(event_type)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("timestamp < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        self.log_writer.flush()  # события из буфера тоже попадают в выгрузку
+        uri = pathlib.Path(self.db_path).resolve().as_uri() + "?mode=ro"
+        # Пачки могут читаться из разных потоков, но строго по очереди
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        try:
+            cursor = conn.execute(
+                f"""
+                SELECT id, timestamp, event_type, message, user_id, chat_id, outcome FROM logs
+                {where} ORDER BY timestamp, id
+                """,
+                params
+            )
+            while rows := cursor.fetchmany(chunk_rows):
+                yield rows
+        finally:
+            conn.close()
+
+    def prune_logs_batch(self, older_than: int, batch_size: int = 500, archive: bool = False) -> int:
+        """
+        Удалить (или перенести в logs_archive) одну пачку логов старше older_than.
+        Блокировка держится только на одну пачку; вызывайте до возврата 0.
+        Возвращает число обработанных строк.
+        """
+        with self.lock:
+            ids = [row[0] for row in self.conn.execute(
+                "SELECT id FROM logs WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+                (older_than, batch_size)
+            )]
+            if not ids:
+                return 0
+            placeholders = ",".join("?" * len(ids))
+            with self.conn:
+                if archive:
+                    self.conn.execute(
+                        f"""
+                        INSERT OR IGNORE INTO logs_archive
+                        SELECT id, timestamp, event_type, message, user_id, chat_id, outcome
+                        FROM logs WHERE id IN ({placeholders})
+                        """,
+                        ids
+                    )
+                self.conn.execute(f"DELETE FROM logs WHERE id IN ({placeholders})", ids)
+            return len(ids)
 
     def save_session(self, user_id: int, api_id: int, api_hash: str, session_string: str):
         """Сохранение или обновление данных сессии UserBot."""
         with self.lock:
             self.conn.execute(
                 """
-                INSERT INTO sessions (user_id, api_id, api_hash, session_string) 
-                VALUES (?, ?, ?, ?)
+                INSERT INTO sessions (user_id, api_id, api_hash, session_string, status, status_at) 
+                VALUES (?, ?, ?, ?, 'ok', ?)
                 ON CONFLICT(user_id) DO UPDATE SET
                     api_id=excluded.api_id,
                     api_hash=excluded.api_hash,
-                    session_string=excluded.session_string
+                    session_string=excluded.session_string,
+                    status=excluded.status,
+                    status_at=excluded.status_at
                 """,
-                (user_id, api_id, api_hash, session_string)
+                (user_id, api_id, api_hash, session_string, int(time.time()))
             )
             self.conn.commit()
 
@@ -79,10 +562,54 @@ class Database:
             cursor.execute("SELECT api_id, api_hash, session_string FROM sessions WHERE user_id = ?", (user_id,))
             return cursor.fetchone()
 
+    def _chats_version_locked(self) -> int:
+        return self.conn.execute("SELECT version FROM chats_version").fetchone()[0]
+
+    def _graph_locked(self) -> ChatGraph:
+        """
+        Граф зависимостей; вызывается под self.lock. Свои записи обновляют граф
+        на месте, а после изменения зависимостей другим процессом (шарды,
+        веб-интерфейс) - chats_version изменилась - граф строится заново.
+        Коммиты, не трогающие зависимости (логи, /scan), граф не сбрасывают.
+        """
+        version = self._chats_version_locked()
+        if self._chat_graph is None or version != self._graph_version:
+            self._graph_version = version
+            rows = self.conn.execute(
+                "SELECT chat_id, dependency_chat_id FROM chats WHERE dependency_chat_id IS NOT NULL"
+            ).fetchall()
+            self._chat_graph = ChatGraph(rows)
+        return self._chat_graph
+
+    def _write_dependency_locked(self, chat_id: int, dependency_chat_id: int, sql: str, params: tuple):
+        """
+        Записать зависимость чата запросом sql и обновить граф на месте; вызывается
+        под self.lock. Зависимость, замыкающая цикл, - ValueError.
+        """
+        graph = self._graph_locked()
+        if dependency_chat_id is not None and graph.creates_cycle(chat_id, dependency_chat_id):
+            raise ValueError(f"Зависимость {chat_id} -> {dependency_chat_id} создает цикл")
+        with self.conn:
+            cursor = self.conn.execute(sql, params)
+            # Запись держит блокировку базы: между ней и чтением версии чужих коммитов нет
+            version = self._chats_version_locked()
+        changed = cursor.rowcount > 0 and graph.deps.get(chat_id) != dependency_chat_id
+        if version != self._graph_version + changed:
+            self._chat_graph = None  # зависимости успел изменить другой процесс
+        elif changed:
+            graph.set(chat_id, dependency_chat_id)
+            self._graph_version = version
+
+    def get_dependency_chain(self, chat_id: int) -> list:
+        """Цепочка зависимостей чата в порядке отправки (см. ChatGraph.chain)."""
+        with self.lock:
+            return self._graph_locked().chain(chat_id)
+
     def add_chat(self, chat_id: int, chat_name: str, dependency_chat_id: int = None):
-        """Добавить или обновить чат и его зависимость."""
+        """Добавить или обновить чат и его зависимость. Зависимость, замыкающая цикл, - ValueError."""
         with self.lock:
-            self.conn.execute(
+            self._write_dependency_locked(
+                chat_id, dependency_chat_id,
                 """
                 INSERT INTO chats (chat_id, chat_name, dependency_chat_id)
                 VALUES (?, ?, ?)
@@ -92,39 +619,559 @@ class Database:
                 """,
                 (chat_id, chat_name, dependency_chat_id)
             )
+
+    def apply_scan_page(self, user_id: int, page: list, scanned_at: int, full: bool = False) -> tuple[int, int]:
+        """
+        Сохранить страницу результатов /scan одной транзакцией.
+        page - список (chat_id, chat_name, link), link - ключ публичной ссылки или None.
+        Записываются только новые и измененные (имя или ссылка) диалоги; при full=True
+        в chats записываются все. Зависимости существующих чатов не затрагиваются.
+        Возвращает (добавлено, обновлено) относительно прошлого снимка.
+        """
+        if not page:
+            return 0, 0
+        with self.lock:
+            placeholders = ",".join("?" * len(page))
+            known = {row[0]: row[1:] for row in self.conn.execute(
+                f"SELECT chat_id, chat_name, link FROM scan_snapshot WHERE user_id = ? AND chat_id IN ({placeholders})",
+                (user_id, *(row[0] for row in page))
+            )}
+            added = [row for row in page if row[0] not in known]
+            updated = [row for row in page if row[0] in known and known[row[0]] != tuple(row[1:])]
+            renamed = [row for row in updated if known[row[0]][0] != row[1]]
+            with self.conn:
+                self.conn.executemany(
+                    """
+                    INSERT INTO chats (chat_id, chat_name) VALUES (?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET chat_name=excluded.chat_name
+                    """,
+                    [row[:2] for row in (page if full else added + renamed)]
+                )
+                self.conn.executemany(
+                    """
+                    INSERT INTO scan_snapshot (user_id, chat_id, chat_name, scanned_at, link) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id, chat_id) DO UPDATE SET
+                        chat_name=excluded.chat_name,
+                        scanned_at=excluded.scanned_at,
+                        link=excluded.link
+                    """,
+                    [(user_id, chat_id, chat_name, scanned_at, link) for chat_id, chat_name, link in added + updated]
+                )
+            return len(added), len(updated)
+
+    def finish_scan(self, user_id: int, seen: set) -> int:
+        """
+        Завершить /scan: удалить из снимка чаты не из seen (аккаунт в них больше
+        не состоит - они удаляются и из memberships) и запомнить время скана.
+        Возвращает число удаленных чатов.
+        """
+        with self.lock:
+            known = {row[0] for row in self.conn.execute(
+                "SELECT chat_id FROM scan_snapshot WHERE user_id = ?", (user_id,)
+            )}
+            removed = [(user_id, chat_id) for chat_id in known - seen]
+            with self.conn:
+                self.conn.executemany("DELETE FROM scan_snapshot WHERE user_id = ? AND chat_id = ?", removed)
+                self.conn.executemany("DELETE FROM memberships WHERE account_id = ? AND chat_id = ?", removed)
+                self.conn.execute(
+                    """
+                    INSERT INTO scan_runs (user_id, finished_at) VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET finished_at=excluded.finished_at
+                    """,
+                    (user_id, int(time.time()))
+                )
+            return len(removed)
+
+    def add_memberships(self, account_id: int, chat_ids: list, links: list = ()):
+        """Отметить участие аккаунта в чатах и ссылки [(ключ, chat_id)] на них одной транзакцией."""
+        checked_at = int(time.time())
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    """
+                    INSERT INTO memberships (account_id, chat_id, checked_at) VALUES (?, ?, ?)
+                    ON CONFLICT(account_id, chat_id) DO UPDATE SET checked_at=excluded.checked_at
+                    """,
+                    [(account_id, chat_id, checked_at) for chat_id in chat_ids]
+                )
+                self.conn.executemany(
+                    """
+                    INSERT INTO chat_links (link, chat_id, resolved_at) VALUES (?, ?, ?)
+                    ON CONFLICT(link) DO UPDATE SET chat_id=excluded.chat_id, resolved_at=excluded.resolved_at
+                    """,
+                    [(link, chat_id, checked_at) for link, chat_id in links]
+                )
+
+    def get_link_membership(self, account_id: int, link: str, fresh_since: int):
+        """
+        chat_id чата по ссылке link, если аккаунт в нем состоит, иначе None. Участие
+        подтверждают вступление или проверка не раньше fresh_since (memberships)
+        либо снимок /scan, завершенного не раньше fresh_since.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                """
+                SELECT l.chat_id FROM chat_links l
+                JOIN memberships m ON m.account_id = ? AND m.chat_id = l.chat_id
+                WHERE l.link = ? AND l.resolved_at >= ? AND m.checked_at >= ?
+                UNION ALL
+                SELECT s.chat_id FROM scan_snapshot s
+                JOIN scan_runs r ON r.user_id = s.user_id
+                WHERE s.user_id = ? AND s.link = ? AND r.finished_at >= ?
+                LIMIT 1
+                """,
+                (account_id, link, fresh_since, fresh_since, account_id, link, fresh_since)
+            ).fetchone()
+            return row[0] if row else None
+
+    def get_upload(self, account_id: int, sha256: str, kind: str):
+        """Ссылка (media_id, access_hash, file_reference) на загруженный файл или None; отмечает использование."""
+        with self.lock:
+            with self.conn:
+                cursor = self.conn.execute(
+                    "UPDATE uploads SET used_at = ? WHERE account_id = ? AND sha256 = ? AND kind = ?",
+                    (time.time_ns(), account_id, sha256, kind)
+                )
+                if not cursor.rowcount:
+                    return None
+                return self.conn.execute(
+                    "SELECT media_id, access_hash, file_reference FROM uploads "
+                    "WHERE account_id = ? AND sha256 = ? AND kind = ?",
+                    (account_id, sha256, kind)
+                ).fetchone()
+
+    def put_upload(self, account_id: int, sha256: str, kind: str, ref: tuple, max_entries: int):
+        """
+        Сохранить ссылку ref = (media_id, access_hash, file_reference) на загруженный файл.
+        У аккаунта остаются max_entries последних использованных ссылок, остальные удаляются.
+        """
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    """
+                    INSERT OR REPLACE INTO uploads
+                        (account_id, sha256, kind, media_id, access_hash, file_reference, used_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (account_id, sha256, kind, *ref, time.time_ns())
+                )
+                self.conn.execute(
+                    """
+                    DELETE FROM uploads WHERE account_id = ? AND used_at <= (
+                        SELECT used_at FROM uploads WHERE account_id = ?
+                        ORDER BY used_at DESC LIMIT 1 OFFSET ?
+                    )
+                    """,
+                    (account_id, account_id, max_entries)
+                )
+
+    def delete_upload(self, account_id: int, sha256: str, kind: str):
+        """Забыть ссылку на файл (ссылка устарела)."""
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM uploads WHERE account_id = ? AND sha256 = ? AND kind = ?",
+                (account_id, sha256, kind)
+            )
             self.conn.commit()
 
-    def get_chats(self):
-        """Получить список всех чатов и их зависимостей."""
+    def get_cooldown(self, account_id: int, chat: str, operation: str) -> float:
+        """Срок окончания ожидания (time.time()) или 0, если ожидание истекло или не задано."""
         with self.lock:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT chat_id, chat_name, dependency_chat_id FROM chats")
+            cursor = self.conn.execute(
+                "SELECT deadline FROM cooldowns WHERE account_id = ? AND chat = ? AND operation = ? AND deadline > ?",
+                (account_id, chat, operation, time.time())
+            )
+            row = cursor.fetchone()
+            return row[0] if row else 0.0
+
+    def set_cooldown(self, account_id: int, chat: str, operation: str, deadline: float):
+        """Сохранить срок ожидания; заодно удаляются истекшие записи."""
+        with self.lock:
+            self.conn.execute("DELETE FROM cooldowns WHERE deadline <= ?", (time.time(),))
+            self.conn.execute(
+                """
+                INSERT INTO cooldowns (account_id, chat, operation, deadline) VALUES (?, ?, ?, ?)
+                ON CONFLICT(account_id, chat, operation) DO UPDATE SET
+                    deadline=max(deadline, excluded.deadline)
+                """,
+                (account_id, chat, operation, deadline)
+            )
+            self.conn.commit()
+
+    def enqueue_job(self, user_id: int, chat_id: int, kind: str, payload: str) -> int:
+        """Добавить задачу в очередь. Возвращает номер задачи."""
+        with self.lock:
+            now = int(time.time())
+            cursor = self.conn.execute(
+                "INSERT INTO jobs (user_id, chat_id, kind, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, chat_id, kind, payload, now, now)
+            )
+            self.conn.commit()
+            return cursor.lastrowid
+
+    def claim_job(self):
+        """Взять самую старую задачу из очереди и пометить ее running. Возвращает (id, user_id, chat_id, kind, payload)."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, user_id, chat_id, kind, payload FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row:
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?",
+                    (int(time.time()), row[0])
+                )
+                self.conn.commit()
+            return row
+
+    def update_job_payload(self, job_id: int, payload: str):
+        """Сохранить промежуточное состояние задачи."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET payload = ?, updated_at = ? WHERE id = ?",
+                (payload, int(time.time()), job_id)
+            )
+            self.conn.commit()
+
+    def finish_job(self, job_id: int, status: str, result: str = None):
+        """Завершить задачу со статусом done или failed."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE id = ?",
+                (status, result, int(time.time()), job_id)
+            )
+            self.conn.commit()
+
+    def requeue_running_jobs(self) -> int:
+        """Вернуть в очередь задачи, прерванные остановкой процесса."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'",
+                (int(time.time()),)
+            )
+            self.conn.commit()
+            return cursor.rowcount
+
+    def get_jobs(self, user_id: int, limit: int = 15):
+        """Последние задачи пользователя: (id, kind, status, result, created_at, updated_at)."""
+        with self.lock:
+            cursor = self.conn.execute(
+                """
+                SELECT id, kind, status, result, created_at, updated_at FROM jobs
+                WHERE user_id = ? ORDER BY id DESC LIMIT ?
+                """,
+                (user_id, limit)
+            )
             return cursor.fetchall()
 
-    def get_chat_dependency(self, chat_id: int):
-        """Получить зависимость для чата."""
+    def delete_finished_jobs(self, older_than: int) -> int:
+        """Удалить завершенные задачи, обновленные раньше older_than."""
         with self.lock:
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT dependency_chat_id FROM chats WHERE chat_id=?", (chat_id,))
-            row = cursor.fetchone()
-            return row[0] if row else None
+            cursor = self.conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (older_than,)
+            )
+            self.conn.commit()
+            return cursor.rowcount
+
+    def fsm_get(self, key: str, fresh_since: int) -> tuple:
+        """(state, data) состояния FSM, обновленного не раньше fresh_since, иначе (None, None)."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT state, data FROM fsm_states WHERE key = ? AND updated_at >= ?",
+                (key, fresh_since)
+            ).fetchone()
+            return row if row else (None, None)
+
+    def fsm_set_state(self, key: str, state: str = None):
+        """Установить состояние FSM; пустая запись (без состояния и данных) удаляется."""
+        self._fsm_set("state", key, state)
+
+    def fsm_set_data(self, key: str, data: bytes = None):
+        """Сохранить сериализованные данные FSM; пустая запись удаляется."""
+        self._fsm_set("data", key, data)
+
+    def _fsm_set(self, column: str, key: str, value):
+        with self.lock:
+            if value is None:
+                self.conn.execute(f"UPDATE fsm_states SET {column} = NULL WHERE key = ?", (key,))
+                self.conn.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data IS NULL", (key,))
+            else:
+                self.conn.execute(
+                    f"""
+                    INSERT INTO fsm_states (key, {column}, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET {column}=excluded.{column}, updated_at=excluded.updated_at
+                    """,
+                    (key, value, int(time.time()))
+                )
+            self.conn.commit()
+
+    def fsm_delete_expired(self, older_than: int, batch_size: int = 500) -> int:
+        """Удалить одну пачку состояний FSM, не обновлявшихся с older_than."""
+        with self.lock:
+            cursor = self.conn.execute(
+                """
+                DELETE FROM fsm_states WHERE key IN (
+                    SELECT key FROM fsm_states WHERE updated_at < ? LIMIT ?
+                )
+                """,
+                (older_than, batch_size)
+            )
+            self.conn.commit()
+            return cursor.rowcount
+
+    def get_chats_page(self, after: int = None, before: int = None, limit: int = 30,
+                       has_dependency: bool = False, prefix: str = None):
+        """
+        Страница чатов по возрастанию chat_id с keyset-пагинацией:
+        after - следующая страница после chat_id, before - предыдущая перед chat_id.
+        Возвращает (список (chat_id, chat_name, dependency_chat_id), есть ли еще строки в этом направлении).
+        """
+        conditions, params = [], []
+        if has_dependency:
+            conditions.append("dependency_chat_id IS NOT NULL")
+        if prefix:
+            conditions.append("chat_name >= ? AND chat_name < ?")
+            params.extend((prefix, prefix + "\U0010ffff"))
+        if before is not None:
+            conditions.append("chat_id < ?")
+            params.append(before)
+            order = "DESC"
+        else:
+            if after is not None:
+                conditions.append("chat_id > ?")
+                params.append(after)
+            order = "ASC"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            rows = self.conn.execute(
+                f"""
+                SELECT chat_id, chat_name, dependency_chat_id FROM chats
+                {where} ORDER BY chat_id {order} LIMIT ?
+                """,
+                (*params, limit + 1)
+            ).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+        return rows, has_more
+
+    def find_chats(self, query: str, limit: int = 20):
+        """
+        Поиск чатов по подстроке в названии, лучшие совпадения первыми.
+        Возвращает список (chat_id, chat_name, dependency_chat_id).
+        """
+        with self.lock:
+            # trigram находит только запросы от 3 символов
+            if self.fts_enabled and len(query) >= 3:
+                cursor = self.conn.execute(
+                    """
+                    SELECT c.chat_id, c.chat_name, c.dependency_chat_id
+                    FROM chats_fts JOIN chats c ON c.chat_id = chats_fts.rowid
+                    WHERE chats_fts MATCH ? ORDER BY bm25(chats_fts) LIMIT ?
+                    """,
+                    ('"' + query.replace('"', '""') + '"', limit)
+                )
+            else:
+                # Короткие запросы и SQLite без trigram: полный просмотр без учета регистра (и для кириллицы)
+                pattern = query.casefold().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                cursor = self.conn.execute(
+                    "SELECT chat_id, chat_name, dependency_chat_id FROM chats "
+                    "WHERE casefold(chat_name) LIKE ? ESCAPE '\\' LIMIT ?",
+                    (f"%{pattern}%", limit)
+                )
+            return cursor.fetchall()
 
     def set_chat_dependency(self, chat_id: int, dependency_chat_id: int):
-        """Установить/обновить зависимость для чата."""
+        """Установить/обновить зависимость для чата. Зависимость, замыкающая цикл, - ValueError."""
         with self.lock:
-            self.conn.execute(
+            self._write_dependency_locked(
+                chat_id, dependency_chat_id,
                 "UPDATE chats SET dependency_chat_id=? WHERE chat_id=?",
                 (dependency_chat_id, chat_id)
             )
+
+    def get_sessions_page(self, after: int = None, limit: int = 20):
+        """Страница сохраненных сессий по возрастанию user_id: список (user_id, api_id)."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "SELECT user_id, api_id FROM sessions WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (after if after is not None else -2 ** 63, limit)
+            )
+            return cursor.fetchall()
+
+    def load_tg_session(self, account_id: int, origin: str):
+        """
+        Сохраненная сессия Telethon аккаунта: (dc_id, server_address, port, auth_key) или None,
+        сущности [(id, hash, username, phone, name)] и состояния обновлений
+        [(entity_id, pts, qts, date, seq)]. Если сессия импортирована из другой строки
+        origin (повторный /login), старые данные удаляются: хэши доступа привязаны к аккаунту.
+        Сущности и состояния без строки сессии (их записал клиент, отключившийся уже после
+        выхода из аккаунта) тоже удаляются.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT origin, dc_id, server_address, port, auth_key FROM tg_sessions WHERE account_id = ?",
+                (account_id,)
+            ).fetchone()
+            if row is None or row[0] != origin:
+                with self.conn:
+                    for table in ("tg_sessions", "tg_entities", "tg_update_state"):
+                        self.conn.execute(f"DELETE FROM {table} WHERE account_id = ?", (account_id,))
+                return None, [], []
+            entities = self.conn.execute(
+                "SELECT id, hash, username, phone, name FROM tg_entities WHERE account_id = ?", (account_id,)
+            ).fetchall()
+            states = self.conn.execute(
+                "SELECT entity_id, pts, qts, date, seq FROM tg_update_state WHERE account_id = ?", (account_id,)
+            ).fetchall()
+            return row[1:], entities, states
+
+    def save_tg_session(self, account_id: int, origin: str, session_row: tuple = None,
+                        entities: list = (), states: list = ()):
+        """
+        Записать накопленные изменения сессии Telethon одной транзакцией:
+        session_row = (dc_id, server_address, port, auth_key) или None, если не менялась.
+        """
+        with self.lock:
+            with self.conn:
+                if session_row is not None:
+                    self.conn.execute(
+                        """
+                        INSERT INTO tg_sessions (account_id, origin, dc_id, server_address, port, auth_key)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(account_id) DO UPDATE SET
+                            origin=excluded.origin, dc_id=excluded.dc_id, server_address=excluded.server_address,
+                            port=excluded.port, auth_key=excluded.auth_key
+                        """,
+                        (account_id, origin, *session_row)
+                    )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO tg_entities (account_id, id, hash, username, phone, name) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(account_id, *entity) for entity in entities]
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO tg_update_state (account_id, entity_id, pts, qts, date, seq) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(account_id, *state) for state in states]
+                )
+
+    def delete_tg_session(self, account_id: int):
+        """Удалить сессию Telethon аккаунта вместе с кэшем сущностей (выход из аккаунта)."""
+        with self.lock:
+            with self.conn:
+                for table in ("tg_sessions", "tg_entities", "tg_update_state"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE account_id = ?", (account_id,))
+
+    def get_sessions_for_warmup(self, limit: int, shard: tuple = None):
+        """
+        Сессии для прогрева пула при запуске: (user_id, api_id, api_hash, session_string).
+        Сессии со статусом unauthorized и banned пропускаются - им нужен повторный /login.
+        shard = (номер, всего) - только сессии этого шарда (user_id % всего == номер).
+        """
+        shard_id, shards = shard or (0, 1)
+        with self.lock:
+            cursor = self.conn.execute(
+                "SELECT user_id, api_id, api_hash, session_string FROM sessions "
+                "WHERE status NOT IN ('unauthorized', 'banned') AND ((user_id % ?) + ?) % ? = ? "
+                "ORDER BY user_id LIMIT ?",
+                (shards, shards, shards, shard_id, limit)
+            )
+            return cursor.fetchall()
+
+    def set_session_status(self, user_id: int, status: str):
+        """Записать состояние сессии (см. SESSION_STATUSES) и время проверки."""
+        if status not in SESSION_STATUSES:
+            raise ValueError(f"Неизвестный статус сессии: {status}")
+        with self.lock:
+            self.conn.execute(
+                "UPDATE sessions SET status = ?, status_at = ? WHERE user_id = ?",
+                (status, int(time.time()), user_id)
+            )
             self.conn.commit()
 
+    def set_session_statuses(self, items):
+        """Записать состояния пачки сессий [(user_id, status)] одной транзакцией."""
+        now = int(time.time())
+        rows = []
+        for user_id, status in items:
+            if status not in SESSION_STATUSES:
+                raise ValueError(f"Неизвестный статус сессии: {status}")
+            rows.append((status, now, user_id))
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("UPDATE sessions SET status = ?, status_at = ? WHERE user_id = ?", rows)
+
+    def get_session_status(self, user_id: int):
+        """Состояние сессии и время проверки: (status, status_at) или None."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT status, status_at FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
     def delete_session(self, user_id: int):
-        """Удалить сессию UserBot по user_id управляющего бота."""
+        """Удалить сессию UserBot по user_id управляющего бота (вместе с данными Telethon)."""
         with self.lock:
-            self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
-            self.conn.commit()
+            with self.conn:
+                self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+                # ключ авторизации, кэш сущностей Telethon, участие в чатах и загрузки без сессии не нужны
+                self.conn.execute("DELETE FROM memberships WHERE account_id = ?", (user_id,))
+                self.conn.execute("DELETE FROM scan_snapshot WHERE user_id = ?", (user_id,))
+                self.conn.execute("DELETE FROM scan_runs WHERE user_id = ?", (user_id,))
+                self.conn.execute("DELETE FROM uploads WHERE account_id = ?", (user_id,))
+                for table in ("tg_sessions", "tg_entities", "tg_update_state"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE account_id = ?", (user_id,))
 
     def close(self):
-        """Закрытие соединения с базой данных."""
+        """Закрытие соединения с базой данных (после записи буфера логов)."""
         if self.conn:
-            self.conn.close()
\ No newline at end of file
+            self.log_writer.close()
+            self.conn.close()
+
+
+def _log_failed_submit(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Ошибка фоновой записи в БД: {future.exception()}")
+
+
+class AsyncDatabase:
+    """
+    Асинхронная обертка над Database.
+    Каждый метод Database доступен как корутина и выполняется в отдельном
+    потоке БД, поэтому event loop никогда не ждет SQLite (lock, commit, fsync).
+    Один поток сохраняет порядок запросов и ту же семантику, что у Database.
+    """
+    def __init__(self, database: Database):
+        self.sync = database
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+    def __getattr__(self, name):
+        attr = getattr(self.sync, name)
+        if not callable(attr) or name.startswith('_'):
+            return attr
+
+        @functools.wraps(attr)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(attr, *args, **kwargs))
+
+        # Кэшируем обертку, чтобы __getattr__ не вызывался повторно
+        setattr(self, name, call)
+        return call
+
+    def submit(self, name: str, *args):
+        """
+        Поставить вызов метода Database в поток БД, не дожидаясь результата.
+        Для записей из синхронного кода (например, сессии Telethon); порядок
+        с остальными запросами сохраняется, close() дождется выполнения.
+        """
+        future = self._executor.submit(getattr(self.sync, name), *args)
+        future.add_done_callback(_log_failed_submit)
+        return future
+
+    async def close(self):
+        """Закрытие соединения в потоке БД и остановка потока."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.sync.close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,97 @@
+# fsm_storage.py
+import asyncio
+import json
+import logging
+import os
+import time
+import zlib
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+FSM_TTL = int(os.getenv("USERBOT_FSM_TTL", "86400"))  # секунд бездействия до удаления состояния
+FSM_SWEEP_INTERVAL = 300
+FSM_SWEEP_BATCH = 500
+COMPRESS_THRESHOLD = 256  # данные длиннее сжимаются zlib
+
+_RAW = b"j"
+_COMPRESSED = b"z"
+
+
+def pack_data(data: Dict[str, Any]) -> Optional[bytes]:
+    """Компактная сериализация данных состояния: JSON без пробелов, крупное - zlib."""
+    if not data:
+        return None
+    raw = json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+    if len(raw) > COMPRESS_THRESHOLD:
+        return _COMPRESSED + zlib.compress(raw)
+    return _RAW + raw
+
+def unpack_data(blob: Optional[bytes]) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    marker, payload = blob[:1], blob[1:]
+    if marker == _COMPRESSED:
+        payload = zlib.decompress(payload)
+    return json.loads(payload)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в базе проекта (таблица fsm_states).
+    Состояния переживают перезапуск, а в памяти процесса не копятся:
+    состояния без активности дольше ttl считаются отсутствующими и
+    удаляются пачками фоновой задачей run_sweeper().
+    """
+
+    def __init__(self, db, ttl: int = FSM_TTL):
+        self.db = db  # AsyncDatabase
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            getattr(key, "business_connection_id", None), key.destiny,
+        ))
+
+    def _fresh_since(self) -> int:
+        return int(time.time()) - self.ttl
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self.db.fsm_set_state(self._key(key), state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self.db.fsm_get(self._key(key), self._fresh_since())
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self.db.fsm_set_data(self._key(key), pack_data(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, blob = await self.db.fsm_get(self._key(key), self._fresh_since())
+        return unpack_data(blob)
+
+    async def close(self) -> None:
+        # Соединением с БД владеет index.py
+        pass
+
+    async def sweep(self) -> int:
+        """Удалить просроченные состояния пачками. Возвращает число удаленных."""
+        removed = 0
+        while True:
+            count = await self.db.fsm_delete_expired(self._fresh_since(), FSM_SWEEP_BATCH)
+            removed += count
+            if count < FSM_SWEEP_BATCH:
+                return removed
+            await asyncio.sleep(0)  # пропускаем вперед запросы обработчиков
+
+    async def run_sweeper(self, interval: float = FSM_SWEEP_INTERVAL):
+        """Фоновая задача периодической очистки брошенных состояний."""
+        while True:
+            removed = await self.sweep()
+            if removed:
+                logging.info(f"Удалено просроченных FSM-состояний: {removed}")
+            await asyncio.sleep(interval)
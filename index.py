@@ -1,22 +1,42 @@
 # index.py
 import asyncio
+import json
 import logging
+import os
+import re
+import signal
+import time
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BotCommand
+from aiogram.types import (Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BotCommand, InputFile,
+                           BufferedInputFile)
 from telethon import errors
 from telethon.sessions import StringSession
 from telethon import TelegramClient # Импортируем явно для создания временного клиента
 from aiogram.filters import StateFilter
 
 # Импортируем наши модули
-from db import Database
+from db import Database, AsyncDatabase
+from fsm_storage import SQLiteStorage
+from jobs import Job, JobError, JobQueue
+import log_export
+import loopmon
+import membership
+import metrics
+import scheduler
+import shards
+import tg_session
+import uploads
 import utils
+import webhook
 
 # --- НАСТРОЙКИ ---
-BOT_TOKEN = ""  # <-- ВАЖНО: Вставьте сюда ваш токен
+BOT_TOKEN = os.getenv("BOT_TOKEN", "")  # <-- ВАЖНО: задайте токен бота (переменная окружения BOT_TOKEN)
+LOG_RETENTION_DAYS = int(os.getenv("USERBOT_LOG_RETENTION_DAYS", "30"))  # 0 - хранить логи вечно
+LOG_RETENTION_ARCHIVE = os.getenv("USERBOT_LOG_RETENTION_ARCHIVE", "0") == "1"  # переносить в logs_archive
+LOG_RETENTION_BATCH = 500
 # -----------------
 
 # Настройка логирования
@@ -24,8 +44,36 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 # Инициализация объектов
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-db = Database()
+db = AsyncDatabase(Database())  # все запросы к SQLite выполняются в отдельном потоке
+fsm_storage = SQLiteStorage(db)  # незавершенные /login переживают перезапуск и удаляются по TTL
+dp = Dispatcher(storage=fsm_storage)
+if metrics.METRICS_ENABLED:
+    dp.message.middleware(metrics.HandlerTimingMiddleware())
+    dp.callback_query.middleware(metrics.HandlerTimingMiddleware())
+scheduler.cooldowns = scheduler.CooldownStore(db)  # FloodWait и антиспам переживают перезапуск
+tg_session.db = db  # ключи авторизации и кэш сущностей Telethon хранятся в userbot.db
+membership.cache = membership.MembershipCache(db)  # повторный /join в известный чат - без запросов
+uploads.cache = uploads.UploadCache(db)  # повторная отправка того же файла - без загрузки
+
+# Фоновые задачи: результат приходит отдельным сообщением в чат, где дали команду
+jobs = JobQueue(db, notify=lambda chat_id, text: bot.send_message(chat_id, text))
+
+# Режим шардов: клиенты UserBot живут в процессах-шардах, здесь только Dispatcher и очередь задач
+router: "shards.ShardRouter | None" = None
+
+async def _userbot_call(user_id: int, method: str, *args):
+    """Вызвать SHARD_HANDLERS[method](*args) там, где живут клиенты user_id: в шарде или здесь."""
+    if router is not None:
+        return await router.call(user_id, method, *args)
+    return await SHARD_HANDLERS[method](*args)
+
+async def _userbot_for(user_id: int):
+    """Клиент UserBot пользователя для фоновой задачи."""
+    session_data = await db.get_session(user_id)
+    if not session_data:
+        raise JobError("Сначала авторизуйтесь через /login.")
+    api_id, api_hash, session_string = session_data
+    return await utils.get_userbot_client(user_id, api_id, api_hash, session_string)
 
 # FSM для процесса авторизации UserBot
 class Login(StatesGroup):
@@ -40,18 +88,30 @@ class Login(StatesGroup):
 @dp.message(CommandStart(), StateFilter("*"))
 async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
-    await message.answer(
+    text = (
         "👋 Привет! Я бот для управления вашим UserBot аккаунтом.\n\n"
         "Доступные команды:\n"
         "/login - Авторизация или переавторизация вашего аккаунта.\n"
         "/status - Проверить статус UserBot.\n"
         "/join <ссылка> - Вступить в чат по публичной или приватной ссылке.\n"
-        "/send <id_чата> <текст> - Отправить сообщение в чат."
+        "/send <id_чата> <текст> - Отправить сообщение в чат (или фото/документ с этой подписью).\n"
+        "/scan [full] - Сканировать чаты и каналы аккаунта.\n"
+        "/addchat <chat_id> <название> - Добавить чат вручную.\n"
+        "/findchat <часть названия> - Найти чат по названию.\n"
+        "/listchats [dep] [префикс] - Список чатов и зависимостей.\n"
+        "/senddep <chat_id> <текст> - Рассылка с учётом зависимостей.\n"
+        "/jobs - Мои фоновые задачи.\n"
+        "/logs [тип] [часов] - Мои события.\n"
+        "/exportlogs [с] [по] [тип] [csv|jsonl] - Выгрузка логов в gzip."
     )
+    if message.from_user.id in loopmon.ADMIN_IDS:
+        text += "\n/profile <секунд> - Профилирование бота (администраторы)."
+    await message.answer(text)
 
 @dp.message(Command("login"), StateFilter("*"))
 async def cmd_login(message: Message, state: FSMContext):
     await state.clear()
+    await utils.pending_logins.drop(message.from_user.id)
     await state.set_state(Login.api_id)
     await message.answer("Введите ваш `api_id`. Его можно получить на my.telegram.org.", parse_mode="Markdown")
 
@@ -71,6 +131,33 @@ async def process_api_hash(message: Message, state: FSMContext):
     await state.set_state(Login.phone)
     await message.answer("Хорошо. Теперь введите номер телефона в международном формате (например, +79123456789).")
 
+async def _login_client(user_id: int, data: dict) -> TelegramClient:
+    """
+    Подключенный клиент незавершенного входа: из кэша pending_logins или,
+    если его там нет (перезапуск бота), восстановленный из temp_session.
+    """
+    entry = utils.pending_logins.get(user_id)
+    if entry is not None:
+        return entry.client
+    client = TelegramClient(StringSession(data.get('temp_session')), data['api_id'], data['api_hash'])
+    await client.connect()
+    await utils.pending_logins.put(user_id, client)
+    return client
+
+async def _finish_login(user_id: int, data: dict, client: TelegramClient, me, event_type: str, note: str):
+    """Сохранить сессию и передать уже подключенный клиент в пул вместе с профилем из sign_in."""
+    utils.pending_logins.pop(user_id)
+    session_str = client.session.save()
+    await db.save_session(user_id, data['api_id'], data['api_hash'], session_str)
+    await db.log_event(event_type, f"Пользователь {user_id} успешно авторизовался{note}.",
+                       user_id=user_id, outcome="ok")
+    if router is None:
+        await utils.userbot_pool.adopt(user_id, session_str, client, me)
+    else:
+        # Подключенный клиент нельзя передать в другой процесс: шард подключится по новой сессии
+        await client.disconnect()
+        await _userbot_call(user_id, "discard", user_id)
+
 @dp.message(Login.phone)
 async def process_phone(message: Message, state: FSMContext):
     phone_number = message.text.strip()
@@ -82,108 +169,134 @@ async def process_phone(message: Message, state: FSMContext):
     api_id = data.get("api_id")
     api_hash = data.get("api_hash")
 
-    # Создаем временный клиент для получения кода
+    # Клиент входа остается подключенным до конца авторизации
     temp_client = TelegramClient(StringSession(), api_id, api_hash)
     await message.answer("Подключаюсь к Telegram для отправки кода...")
     
     try:
         await temp_client.connect()
         sent_code = await temp_client.send_code_request(phone_number)
-        # Сохраняем phone_code_hash и временную сессию
+        await utils.pending_logins.put(message.from_user.id, temp_client)
+        # temp_session нужна только для продолжения входа после перезапуска бота
         await state.update_data(phone_code_hash=sent_code.phone_code_hash, temp_session=temp_client.session.save())
         await state.set_state(Login.code)
         await message.answer("Код подтверждения отправлен вам в Telegram. Пожалуйста, введите его.")
     except Exception as e:
         await message.answer(f"Произошла ошибка: {e}")
         await state.clear()
-    finally:
         await temp_client.disconnect()
 
 @dp.message(Login.code)
 async def process_code(message: Message, state: FSMContext):
-    await state.update_data(code=message.text.strip())
+    user_id = message.from_user.id
     data = await state.get_data()
     
-    # Используем временную сессию, сохранённую после отправки кода
-    session_str = data.get('temp_session')
-    temp_client = TelegramClient(StringSession(session_str), data['api_id'], data['api_hash'])
-    
     try:
-        await temp_client.connect()
-        await temp_client.sign_in(
+        temp_client = await _login_client(user_id, data)
+        me = await temp_client.sign_in(
             phone=data['phone'],
-            code=data['code'],
+            code=message.text.strip(),
             phone_code_hash=data['phone_code_hash']
         )
         
-        session_str_final = temp_client.session.save()
-        db.save_session(message.from_user.id, data['api_id'], data['api_hash'], session_str_final)
-        db.log_event("AUTH_SUCCESS", f"Пользователь {message.from_user.id} успешно авторизовался.")
-        
+        await _finish_login(user_id, data, temp_client, me, "AUTH_SUCCESS", "")
         await message.answer("✅ Авторизация прошла успешно! Ваша сессия надежно сохранена.")
         await state.clear()
         
     except errors.SessionPasswordNeededError:
+        # Сессия уже прошла проверку кода - сохраняем ее для шага с паролем
+        await state.update_data(temp_session=temp_client.session.save())
         await state.set_state(Login.password)
         await message.answer("Аккаунт защищен двухфакторной аутентификацией. Введите облачный пароль.")
     except errors.PhoneCodeInvalidError:
         await message.answer("❌ Неверный код. Попробуйте снова /login.")
+        await utils.pending_logins.drop(user_id)
         await state.clear()
     except Exception as e:
         await message.answer(f"❌ Произошла ошибка: {e}")
+        await utils.pending_logins.drop(user_id)
         await state.clear()
-    finally:
-        if temp_client.is_connected():
-            await temp_client.disconnect()
 
 @dp.message(Login.password)
 async def process_password(message: Message, state: FSMContext):
+    user_id = message.from_user.id
     data = await state.get_data()
-    temp_client = TelegramClient(StringSession(), data['api_id'], data['api_hash'])
 
     try:
-        await temp_client.connect()
-        await temp_client.sign_in(password=message.text.strip())
+        temp_client = await _login_client(user_id, data)
+        me = await temp_client.sign_in(password=message.text.strip())
 
-        session_str = temp_client.session.save()
-        db.save_session(message.from_user.id, data['api_id'], data['api_hash'], session_str)
-        db.log_event("AUTH_SUCCESS_2FA", f"Пользователь {message.from_user.id} успешно авторизовался с 2FA.")
-        
+        await _finish_login(user_id, data, temp_client, me, "AUTH_SUCCESS_2FA", " с 2FA")
         await message.answer("✅ Пароль принят! Авторизация успешна. Ваша сессия сохранена.")
         
     except errors.PasswordHashInvalidError:
         await message.answer("❌ Неверный пароль. Попробуйте начать заново с /login.")
+        await utils.pending_logins.drop(user_id)
     except Exception as e:
         await message.answer(f"❌ Произошла ошибка: {e}")
+        await utils.pending_logins.drop(user_id)
     finally:
-        if temp_client.is_connected():
-            await temp_client.disconnect()
         await state.clear()
 
+SESSION_STATUS_LABELS = {
+    "unknown": "состояние еще не проверялось",
+    "ok": "активен",
+    "unauthorized": "сессия больше не авторизована",
+    "banned": "аккаунт заблокирован или удален",
+    "flood": "аккаунт ограничен FloodWait",
+    "error": "не удалось подключиться",
+}
+
+async def _account_status(user_id: int, session_data: tuple) -> tuple:
+    """
+    Состояние аккаунта из кэша пула: ((имя, username) или None, состояние, время проверки).
+    Клиент подключается только при промахе кэша; подключение само получает профиль.
+    """
+    cached = utils.userbot_pool.cached_status(user_id)
+    if cached is None:
+        status, checked_at = await db.get_session_status(user_id)
+        if status in ("unauthorized", "banned"):
+            return None, status, checked_at
+        api_id, api_hash, session_string = session_data
+        try:
+            await utils.get_userbot_client(user_id, api_id, api_hash, session_string)
+        except Exception as e:
+            await db.set_session_status(user_id, utils.session_status_for_error(e))
+            raise
+        cached = utils.userbot_pool.cached_status(user_id)
+        await db.set_session_status(user_id, cached[1])
+    me, status, checked_at = cached
+    return ((me.first_name, me.username) if me is not None else None), status, checked_at
+
 @dp.message(Command("status"), StateFilter("*"))
 async def cmd_status(message: Message, state: FSMContext):
     await state.clear()
-    session_data = db.get_session(message.from_user.id)
+    session_data = await db.get_session(message.from_user.id)
     if not session_data:
         return await message.answer("❌ Вы не авторизованы. Используйте /login.")
     
-    api_id, api_hash, session_string = session_data
+    user_id = message.from_user.id
+    # Ответ из кэша пула: профиль получен при подключении и обновляется фоновой проверкой
     try:
-        client = await utils.get_userbot_client(message.from_user.id, api_id, api_hash, session_string)
-        me = await client.get_me()
-        # --- Добавляем inline-кнопку ---
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(text="Выйти из аккаунта", callback_data="logout_userbot")]
-            ]
-        )
-        await message.answer(
-            f"✅ UserBot активен.\nАккаунт: **{me.first_name}** (`@{me.username}`)",
-            parse_mode="Markdown",
-            reply_markup=keyboard
-        )
+        profile, status, checked_at = await _userbot_call(user_id, "status", user_id, tuple(session_data))
     except Exception as e:
-        await message.answer(f"❌ Не удалось проверить статус. Ошибка: {e}\n\nВозможно, нужно пройти авторизацию заново: /login")
+        return await message.answer(f"❌ Не удалось проверить статус. Ошибка: {e}\n\nВозможно, нужно пройти авторизацию заново: /login")
+    if profile is None or status in ("unauthorized", "banned"):
+        return await message.answer(f"❌ {SESSION_STATUS_LABELS[status]}. Пройдите авторизацию заново: /login")
+    first_name, username = profile
+    # --- Добавляем inline-кнопку ---
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="Выйти из аккаунта", callback_data="logout_userbot")]
+        ]
+    )
+    icon = "✅" if status == "ok" else "⚠️"
+    await message.answer(
+        f"{icon} UserBot: {SESSION_STATUS_LABELS[status]}.\nАккаунт: **{first_name}** (`@{username}`)\n"
+        f"Проверено {int(time.time() - checked_at)} с назад.",
+        parse_mode="Markdown",
+        reply_markup=keyboard
+    )
 
 @dp.message(Command("join"), StateFilter("*"))
 async def cmd_join(message: Message, state: FSMContext):
@@ -194,66 +307,125 @@ async def cmd_join(message: Message, state: FSMContext):
     
     chat_link = args[1]
     
-    session_data = db.get_session(message.from_user.id)
-    if not session_data:
+    if not await db.get_session(message.from_user.id):
         return await message.answer("❌ Сначала авторизуйтесь через /login.")
-        
-    api_id, api_hash, session_string = session_data
-    client = await utils.get_userbot_client(message.from_user.id, api_id, api_hash, session_string)
-    
-    await message.answer(f"⏳ Пытаюсь вступить в `{chat_link}`...", parse_mode="Markdown")
+
+    job_id = await jobs.enqueue(message.from_user.id, message.chat.id, "join", chat_link=chat_link)
+    await message.answer(f"🗂 Задача #{job_id}: вступление в {chat_link} поставлено в очередь. Статус: /jobs")
+
+@jobs.handler("join")
+async def job_join(job: Job) -> str:
+    client = await _userbot_for(job.user_id)
+    chat_link = job.payload["chat_link"]
     success, msg = await utils.join_chat(client, chat_link)
     
     event_type = "JOIN_SUCCESS" if success else "JOIN_FAIL"
-    db.log_event(event_type, msg)
-    
-    await message.answer(msg)
+    await db.log_event(event_type, msg, user_id=job.user_id, outcome="ok" if success else "fail")
+    if not success:
+        raise JobError(msg)
+    return msg
+
+BOT_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # больше Bot API скачать не дает
+
+def _attachment_of(message: Message):
+    """Фото или документ из сообщения (или из сообщения, на которое оно отвечает) для /send."""
+    for source in (message, message.reply_to_message):
+        if source is None:
+            continue
+        if source.photo:
+            photo = source.photo[-1]  # самый крупный размер
+            return {"kind": "photo", "file_id": photo.file_id, "name": "photo.jpg", "size": photo.file_size}
+        if source.document:
+            return {"kind": "document", "file_id": source.document.file_id,
+                    "name": source.document.file_name or "file", "size": source.document.file_size}
+    return None
 
 @dp.message(Command("send"), StateFilter("*"))
 async def cmd_send(message: Message, state: FSMContext):
     await state.clear()
-    parts = message.text.split(maxsplit=2)
-    if len(parts) < 3:
-        return await message.answer("Использование: `/send <id_чата_или_@username> <текст сообщения>`", parse_mode="Markdown")
+    # Файл можно прислать с подписью "/send <чат> [подпись]" или ответить командой на сообщение с файлом
+    parts = (message.text or message.caption or "").split(maxsplit=2)
+    attachment = _attachment_of(message)
+    if len(parts) < (2 if attachment else 3):
+        return await message.answer(
+            "Использование: `/send <id_чата_или_@username> <текст сообщения>`\n"
+            "Фото или документ: подпись `/send <чат> [подпись]` к файлу или ответ этой командой на файл",
+            parse_mode="Markdown")
     
     chat_entity = parts[1]
-    text_to_send = parts[2]
+    text_to_send = parts[2] if len(parts) > 2 else ""
+    if attachment and (attachment.pop("size") or 0) > BOT_DOWNLOAD_LIMIT:
+        return await message.answer("❌ Файл больше 20 МБ: бот не может его скачать.")
     
-    session_data = db.get_session(message.from_user.id)
-    if not session_data:
+    if not await db.get_session(message.from_user.id):
         return await message.answer("❌ Сначала авторизуйтесь через /login.")
-    
-    api_id, api_hash, session_string = session_data
-    client = await utils.get_userbot_client(message.from_user.id, api_id, api_hash, session_string)
 
-    await message.answer(f"⏳ Отправляю сообщение в `{chat_entity}`...", parse_mode="Markdown")
-    success, msg = await utils.send_message(client, chat_entity, text_to_send)
+    job_id = await jobs.enqueue(message.from_user.id, message.chat.id, "send",
+                                chat_entity=chat_entity, text=text_to_send, attachment=attachment)
+    what = "отправка файла" if attachment else "отправка"
+    await message.answer(f"🗂 Задача #{job_id}: {what} в {chat_entity} поставлена в очередь. Статус: /jobs")
 
-    event_type = "SEND_SUCCESS" if success else "SEND_FAIL"
-    db.log_event(event_type, msg)
+@jobs.handler("send")
+async def job_send(job: Job) -> str:
+    client = await _userbot_for(job.user_id)
+    chat_entity = job.payload["chat_entity"]
+    attachment = None
+    if file := job.payload.get("attachment"):
+        data = await bot.download(file["file_id"])
+        attachment = uploads.Attachment(file["kind"], data.getvalue(), file["name"])
+    success, msg = await utils.send_message(client, chat_entity, job.payload["text"], attachment)
 
-    await message.answer(msg)
+    event_type = "SEND_SUCCESS" if success else "SEND_FAIL"
+    await db.log_event(event_type, msg, user_id=job.user_id,
+                       chat_id=int(chat_entity) if chat_entity.lstrip('-').isdigit() else None,
+                       outcome="ok" if success else "fail")
+    if not success:
+        raise JobError(msg)
+    return msg
 
 # === ЧАТЫ И ЗАВИСИМОСТИ ===
+SCAN_PAGE_SIZE = 200  # диалогов на одну транзакцию при /scan
+
 @dp.message(Command("scan"), StateFilter("*"))
-async def cmd_scan(message: Message, state: FSMContext):
+async def cmd_scan(message: Message, state: FSMContext, command: CommandObject):
     await state.clear()
-    session_data = db.get_session(message.from_user.id)
-    if not session_data:
+    full = (command.args or "").strip().lower() == "full"
+    if not await db.get_session(message.from_user.id):
         return await message.answer("❌ Сначала авторизуйтесь через /login.")
-    api_id, api_hash, session_string = session_data
-    client = await utils.get_userbot_client(message.from_user.id, api_id, api_hash, session_string)
-    await message.answer("⏳ Сканирую чаты и каналы...")
-    try:
-        dialogs = await client.get_dialogs()
-        count = 0
-        for d in dialogs:
-            if hasattr(d.entity, 'id') and hasattr(d.entity, 'title'):
-                db.add_chat(d.entity.id, d.entity.title)
-                count += 1
-        await message.answer(f"✅ Найдено и сохранено чатов/каналов: {count}")
-    except Exception as e:
-        await message.answer(f"❌ Ошибка при сканировании: {e}")
+    job_id = await jobs.enqueue(message.from_user.id, message.chat.id, "scan", full=full)
+    await message.answer(f"🗂 Задача #{job_id}: сканирование чатов" + (" (полный режим)" if full else "")
+                         + " поставлено в очередь. Статус: /jobs")
+
+@jobs.handler("scan")
+async def job_scan(job: Job) -> str:
+    client = await _userbot_for(job.user_id)
+    full = job.payload["full"]
+    await job.progress("⏳ Сканирую чаты и каналы...")
+    started = time.monotonic()
+    scanned_at = time.time_ns()
+    total = added = updated = 0
+    page, seen = [], set()
+    # Диалоги читаются потоком и сохраняются страницами, а не грузятся целиком.
+    # Ссылки на публичные чаты попадают в снимок: по нему /join узнает об участии
+    async for d in client.iter_dialogs():
+        if hasattr(d.entity, 'id') and hasattr(d.entity, 'title'):
+            username = getattr(d.entity, 'username', None)
+            link = membership.ChatLink("username", username.lower()).key if username else None
+            page.append((d.entity.id, d.entity.title, link))
+            seen.add(d.entity.id)
+        if len(page) >= SCAN_PAGE_SIZE:
+            a, u = await db.apply_scan_page(job.user_id, page, scanned_at, full)
+            total, added, updated = total + len(page), added + a, updated + u
+            page = []
+    a, u = await db.apply_scan_page(job.user_id, page, scanned_at, full)
+    total, added, updated = total + len(page), added + a, updated + u
+    removed = await db.finish_scan(job.user_id, seen)
+    elapsed = time.monotonic() - started
+    return (
+        f"Сканирование завершено за {elapsed:.1f} с.\n"
+        f"Чатов/каналов: {total}\n"
+        f"Добавлено: {added}, обновлено: {updated}, удалено: {removed}"
+    )
 
 @dp.message(Command("addchat"), StateFilter("*"))
 async def cmd_addchat(message: Message, state: FSMContext):
@@ -266,26 +438,91 @@ async def cmd_addchat(message: Message, state: FSMContext):
         chat_name = parts[2]
         dependency = None
         if "авито" in chat_name.lower():
-            for c_id, c_name, _ in db.get_chats():
-                if "прогрев" in c_name.lower():
-                    dependency = c_id
-                    break
-        db.add_chat(chat_id, chat_name, dependency)
+            matches = await db.find_chats("прогрев", limit=1)
+            if matches:
+                dependency = matches[0][0]
+        await db.add_chat(chat_id, chat_name, dependency)
         await message.answer(f"Чат {chat_name} сохранён. Зависимость: {dependency}")
     except Exception as e:
         await message.answer(f"Ошибка: {e}")
 
+@dp.message(Command("findchat"), StateFilter("*"))
+async def cmd_findchat(message: Message, state: FSMContext, command: CommandObject):
+    await state.clear()
+    query = (command.args or "").strip()
+    if not query:
+        return await message.answer("Использование: /findchat <часть названия>")
+    matches = await db.find_chats(query, limit=20)
+    if not matches:
+        return await message.answer("Ничего не найдено")
+    await message.answer("\n".join(f"📍 {name} ({chat_id}) -> {dep}" for chat_id, name, dep in matches))
+
+LISTCHATS_PAGE_SIZE = 30
+
+def _listchats_page_markup(rows, has_prev: bool, has_next: bool, has_dependency: bool, prefix: str):
+    """Кнопки навигации; курсор (граничный chat_id) и фильтры передаются в callback_data."""
+    flags = "d" if has_dependency else "-"
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="◀ Назад", callback_data=f"lc:p:{rows[0][0]}:{flags}:{prefix}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="Дальше ▶", callback_data=f"lc:n:{rows[-1][0]}:{flags}:{prefix}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+def _format_chats_page(rows) -> str:
+    return "\n".join(f"📍 {name[:80]} ({chat_id}) -> {dep}" for chat_id, name, dep in rows)
+
 @dp.message(Command("listchats"), StateFilter("*"))
-async def cmd_listchats(message: Message, state: FSMContext):
+async def cmd_listchats(message: Message, state: FSMContext, command: CommandObject):
     await state.clear()
-    chats = db.get_chats()
-    if not chats:
+    # /listchats [dep] [префикс названия]
+    prefix = (command.args or "").strip()
+    has_dependency = prefix.lower() == "dep" or prefix.lower().startswith("dep ")
+    if has_dependency:
+        prefix = prefix[3:].strip()
+    # callback_data ограничена 64 байтами
+    if len(prefix.encode()) > 32 or ":" in prefix:
+        return await message.answer("Префикс слишком длинный или содержит «:».")
+    rows, has_next = await db.get_chats_page(limit=LISTCHATS_PAGE_SIZE, has_dependency=has_dependency,
+                                             prefix=prefix or None)
+    if not rows:
         return await message.answer("Чаты не найдены")
-    text = "\n".join([f"📍 {name} ({chat_id}) -> {dep}" for chat_id, name, dep in chats])
-    await message.answer(text)
+    await message.answer(_format_chats_page(rows),
+                         reply_markup=_listchats_page_markup(rows, False, has_next, has_dependency, prefix))
+
+@dp.callback_query(lambda c: c.data and c.data.startswith("lc:"))
+async def listchats_page_callback(callback: CallbackQuery):
+    _, direction, cursor, flags, prefix = callback.data.split(":", 4)
+    has_dependency = flags == "d"
+    if direction == "n":
+        rows, has_more = await db.get_chats_page(after=int(cursor), limit=LISTCHATS_PAGE_SIZE,
+                                                 has_dependency=has_dependency, prefix=prefix or None)
+        has_prev, has_next = True, has_more
+    else:
+        rows, has_more = await db.get_chats_page(before=int(cursor), limit=LISTCHATS_PAGE_SIZE,
+                                                 has_dependency=has_dependency, prefix=prefix or None)
+        has_prev, has_next = has_more, True
+    if not rows:
+        return await callback.answer("Больше чатов нет.")
+    await callback.message.edit_text(_format_chats_page(rows),
+                                     reply_markup=_listchats_page_markup(rows, has_prev, has_next,
+                                                                         has_dependency, prefix))
+    await callback.answer()
 
 # === АНТИСПАМ: задержка между отправками ===
-last_sent = {}  # {chat_id: datetime}
+SENDDEP_COOLDOWN = 120  # секунд между рассылками /senddep в один чат
+
+async def _senddep_one(job: Job, client, chat_id: int, text: str, event_type: str, label: str) -> str:
+    """Отправка в один чат /senddep с учетом сохраненной задержки антиспама."""
+    wait = await scheduler.cooldowns.remaining(job.user_id, chat_id, "senddep")
+    if wait > 0:
+        await job.progress(f"⏳ Жду {int(wait)} сек для {label}...")
+        await asyncio.sleep(wait)
+    ok, msg = await utils.send_message(client, chat_id, utils.adaptive_text(text))
+    await scheduler.cooldowns.set(job.user_id, chat_id, "senddep", SENDDEP_COOLDOWN)
+    await db.log_event(event_type, msg, user_id=job.user_id, chat_id=chat_id,
+                       outcome="ok" if ok else "fail")
+    return '✅' if ok else '❌'
 
 @dp.message(Command("senddep"), StateFilter("*"))
 async def cmd_senddep(message: Message, state: FSMContext):
@@ -295,51 +532,176 @@ async def cmd_senddep(message: Message, state: FSMContext):
         return await message.answer("Использование: /senddep <chat_id> <текст>")
     try:
         chat_id = int(parts[1])
-        text = parts[2]
-        dep = db.get_chat_dependency(chat_id)
-        session_data = db.get_session(message.from_user.id)
-        if not session_data:
-            return await message.answer("❌ Сначала авторизуйтесь через /login.")
-        api_id, api_hash, session_string = session_data
-        client = await utils.get_userbot_client(message.from_user.id, api_id, api_hash, session_string)
-        results = []
-        # --- Антиспам: задержка ---
-        from datetime import datetime, timedelta
-        now = datetime.now()
-        global last_sent
-        def can_send(cid):
-            if cid in last_sent:
-                diff = (now - last_sent[cid]).total_seconds()
-                return diff >= 120
-            return True
-        # --- Сначала зависимый чат ---
-        if dep:
-            if not can_send(dep):
-                wait = 120 - (now - last_sent[dep]).total_seconds()
-                await message.answer(f"⏳ Жду {int(wait)} сек для зависимого чата...")
-                await asyncio.sleep(wait)
-            ok, msg1 = await utils.send_message(client, dep, utils.adaptive_text(text))
-            last_sent[dep] = datetime.now()
-            db.log_event("SENDDEP_DEP", msg1)
-            results.append(f"Зависимый чат: {'✅' if ok else '❌'}")
-        # --- Потом основной чат ---
-        if not can_send(chat_id):
-            wait = 120 - (now - last_sent[chat_id]).total_seconds()
-            await message.answer(f"⏳ Жду {int(wait)} сек для основного чата...")
-            await asyncio.sleep(wait)
-        ok2, msg2 = await utils.send_message(client, chat_id, utils.adaptive_text(text))
-        last_sent[chat_id] = datetime.now()
-        db.log_event("SENDDEP_MAIN", msg2)
-        results.append(f"Основной чат: {'✅' if ok2 else '❌'}")
-        await message.answer("\n".join(results))
+    except ValueError:
+        return await message.answer("Ошибка: chat_id должен быть числом")
+    if not await db.get_session(message.from_user.id):
+        return await message.answer("❌ Сначала авторизуйтесь через /login.")
+    job_id = await jobs.enqueue(message.from_user.id, message.chat.id, "senddep", chat_id=chat_id, text=parts[2])
+    await message.answer(f"🗂 Задача #{job_id}: рассылка в {chat_id} поставлена в очередь. Статус: /jobs")
+
+@jobs.handler("senddep")
+async def job_senddep(job: Job) -> str:
+    chat_id = job.payload["chat_id"]
+    text = job.payload["text"]
+    chain = await db.get_dependency_chain(chat_id)
+    client = await _userbot_for(job.user_id)
+    results = []
+    # --- Сначала зависимые чаты, от самого глубокого (после перезапуска не отправляем повторно) ---
+    done = job.payload.get("dep_statuses", {})
+    for dep in chain:
+        status = done.get(str(dep))
+        if status is None:
+            status = await _senddep_one(job, client, dep, text, "SENDDEP_DEP", f"зависимого чата {dep}")
+            done[str(dep)] = status
+            await job.checkpoint(dep_statuses=done)
+        results.append(f"Зависимый чат {dep}: {status}")
+    # --- Потом основной чат ---
+    status = await _senddep_one(job, client, chat_id, text, "SENDDEP_MAIN", "основного чата")
+    results.append(f"Основной чат: {status}")
+    return "\n".join(results)
+
+# === ЗАДАЧИ ===
+JOB_STATUS_LABELS = {
+    "queued": "⏳ в очереди",
+    "running": "▶️ выполняется",
+    "done": "✅ выполнена",
+    "failed": "❌ ошибка",
+}
+
+@dp.message(Command("jobs"), StateFilter("*"))
+async def cmd_jobs(message: Message, state: FSMContext):
+    await state.clear()
+    rows = await db.get_jobs(message.from_user.id)
+    if not rows:
+        return await message.answer("Задач пока нет.")
+    lines = []
+    for job_id, kind, status, result, created_at, _ in rows:
+        when = time.strftime('%d.%m %H:%M', time.localtime(created_at))
+        line = f"#{job_id} {kind} ({when}) — {JOB_STATUS_LABELS.get(status, status)}"
+        if result:
+            line += f"\n    {result.splitlines()[0][:100]}"
+        lines.append(line)
+    await message.answer("\n".join(lines))
+
+# === ЛОГИ ===
+LOGS_PAGE_SIZE = 15
+# Тип события попадает в callback_data (до 64 байт, поля через ":") - только такие значения
+EVENT_TYPE_RE = re.compile(r"^[A-Z0-9_]{1,20}$")
+
+def _format_logs_page(rows) -> str:
+    lines = []
+    for _, ts, event_type, text, _, chat_id, outcome in rows:
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+        chat = f" чат {chat_id}" if chat_id is not None else ""
+        lines.append(f"🕒 {when} {event_type} [{outcome or '-'}]{chat}: {text[:200]}")
+    return "\n".join(lines)
+
+def _logs_keyboard(rows, event_type, since):
+    """Кнопка следующей страницы; курсор (timestamp, id) передается в callback_data."""
+    if len(rows) < LOGS_PAGE_SIZE:
+        return None
+    row_id, ts = rows[-1][0], rows[-1][1]
+    cursor = f"logs:{ts}:{row_id}:{event_type or '-'}:{since or 0}"
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Дальше ▶", callback_data=cursor)]])
+
+@dp.message(Command("logs"), StateFilter("*"))
+async def cmd_logs(message: Message, state: FSMContext, command: CommandObject):
+    await state.clear()
+    args = (command.args or "").split()
+    event_type, since = None, None
+    for arg in args:
+        if arg.isdigit():
+            since = int(time.time()) - int(arg) * 3600
+        else:
+            event_type = arg.upper()
+    if event_type is not None and not EVENT_TYPE_RE.match(event_type):
+        return await message.answer("❌ Тип события: латинские буквы, цифры и _, до 20 символов "
+                                    "(например, JOIN_SUCCESS). Использование: /logs [тип] [часов]")
+    rows = await db.get_logs_page(user_id=message.from_user.id, event_type=event_type,
+                                  since=since, limit=LOGS_PAGE_SIZE)
+    if not rows:
+        return await message.answer("Записей в логе не найдено.")
+    await message.answer(_format_logs_page(rows), reply_markup=_logs_keyboard(rows, event_type, since))
+
+@dp.callback_query(lambda c: c.data and c.data.startswith("logs:"))
+async def logs_page_callback(callback: CallbackQuery):
+    try:
+        _, ts, row_id, event_type, since = callback.data.split(":")
+        ts, row_id, since = int(ts), int(row_id), int(since) or None
+    except ValueError:
+        return await callback.answer("Устаревшая кнопка, повторите /logs.")
+    event_type = None if event_type == "-" else event_type
+    rows = await db.get_logs_page(user_id=callback.from_user.id, event_type=event_type, since=since,
+                                  before=(ts, row_id), limit=LOGS_PAGE_SIZE)
+    if not rows:
+        return await callback.answer("Это последняя страница.")
+    await callback.message.edit_text(_format_logs_page(rows), reply_markup=_logs_keyboard(rows, event_type, since))
+    await callback.answer()
+
+class LogExportFile(InputFile):
+    """Документ для send_document, который читается из выгрузки по мере отправки."""
+
+    def __init__(self, chunks, filename: str):
+        super().__init__(filename=filename)
+        self.chunks = chunks
+
+    async def read(self, bot: Bot):
+        async for chunk in self.chunks:
+            yield chunk
+
+@dp.message(Command("exportlogs"), StateFilter("*"))
+async def cmd_exportlogs(message: Message, state: FSMContext, command: CommandObject):
+    await state.clear()
+    # /exportlogs [с YYYY-MM-DD] [по YYYY-MM-DD] [тип] [csv|jsonl]
+    days, event_type, fmt = [], None, "csv"
+    for arg in (command.args or "").split():
+        if arg.lower() in log_export.EXPORT_FORMATS:
+            fmt = arg.lower()
+            continue
+        try:
+            days.append(log_export.parse_day(arg))
+        except ValueError:
+            event_type = arg.upper()
+    if len(days) > 2:
+        return await message.answer("Использование: /exportlogs [с YYYY-MM-DD] [по YYYY-MM-DD] [тип] [csv|jsonl]")
+    since = days[0] if days else None
+    until = days[1] + 86400 if len(days) > 1 else None  # день "по" включается целиком
+    await message.answer("⏳ Готовлю выгрузку логов...")
+    chunks = log_export.stream_logs(db, fmt, user_id=message.from_user.id, event_type=event_type,
+                                    since=since, until=until)
+    try:
+        await message.answer_document(LogExportFile(chunks, log_export.export_filename(fmt)),
+                                      caption="Выгрузка логов")
     except Exception as e:
-        await message.answer(f"Ошибка: {e}")
+        await message.answer(f"❌ Не удалось отправить выгрузку: {e}")
+    finally:
+        await chunks.aclose()
+
+@dp.message(Command("profile"), StateFilter("*"))
+async def cmd_profile(message: Message, state: FSMContext, command: CommandObject):
+    await state.clear()
+    if message.from_user.id not in loopmon.ADMIN_IDS:
+        return await message.answer("Команда доступна только администраторам.")
+    args = (command.args or "").strip()
+    if not args.isdigit() or not 1 <= int(args) <= loopmon.PROFILE_MAX_SECONDS:
+        return await message.answer(f"Использование: /profile <секунд от 1 до {loopmon.PROFILE_MAX_SECONDS}>")
+    seconds = int(args)
+    await message.answer(f"⏳ Профилирую процесс {seconds} с...")
+    # Профайлер работает в своем потоке, бот продолжает отвечать
+    folded = await asyncio.get_running_loop().run_in_executor(None, loopmon.sample_profile, seconds)
+    await message.answer_document(
+        BufferedInputFile(folded.encode(), filename=f"profile-{int(time.time())}.folded"),
+        caption="Collapsed stacks: flamegraph.pl profile.folded > profile.svg или speedscope.app"
+    )
 
 # --- Обработчик inline-кнопки выхода ---
 @dp.callback_query(lambda c: c.data == "logout_userbot")
 async def logout_userbot_callback(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.delete_session(user_id)
+    # Сначала отключить клиент: при отключении он сохраняет сессию Telethon, и после удаления
+    # в базе остались бы его сущности и состояния обновлений
+    await _userbot_call(user_id, "discard", user_id)
+    await db.delete_session(user_id)
     await state.clear()
     await callback.message.edit_text("Вы вышли из аккаунта UserBot. Для повторной авторизации используйте /login.")
     await callback.answer("Сессия удалена.")
@@ -351,23 +713,119 @@ async def set_bot_commands(bot: Bot):
         BotCommand(command="status", description="Проверить статус UserBot"),
         BotCommand(command="join", description="Вступить в чат по ссылке"),
         BotCommand(command="send", description="Отправить сообщение в чат"),
-        BotCommand(command="scan", description="Сканировать все чаты/каналы"),
+        BotCommand(command="scan", description="Сканировать чаты/каналы (full - полностью)"),
         BotCommand(command="addchat", description="Добавить чат вручную"),
+        BotCommand(command="findchat", description="Найти чат по названию"),
         BotCommand(command="listchats", description="Список чатов и зависимостей"),
         BotCommand(command="senddep", description="Рассылка с учётом зависимостей"),
+        BotCommand(command="jobs", description="Мои фоновые задачи"),
+        BotCommand(command="logs", description="Мои события: /logs [тип] [часов]"),
+        BotCommand(command="exportlogs", description="Выгрузка логов: /exportlogs [с] [по] [тип]"),
     ]
     await bot.set_my_commands(commands)
 
+async def run_log_retention():
+    """Фоновая очистка логов (небольшими пачками) и завершенных задач старше LOG_RETENTION_DAYS."""
+    while True:
+        older_than = int(time.time()) - LOG_RETENTION_DAYS * 86400
+        pruned = 0
+        while True:
+            count = await db.prune_logs_batch(older_than, LOG_RETENTION_BATCH, archive=LOG_RETENTION_ARCHIVE)
+            pruned += count
+            if count < LOG_RETENTION_BATCH:
+                break
+            await asyncio.sleep(0)  # пропускаем вперед запросы обработчиков
+        pruned_jobs = await db.delete_finished_jobs(older_than)
+        if pruned or pruned_jobs:
+            logging.info(f"Политика хранения: обработано {pruned} старых логов, удалено {pruned_jobs} задач.")
+        await asyncio.sleep(3600)
+
+# === ШАРДЫ ===
+async def _shard_job(job_id: int, user_id: int, chat_id: int, kind: str, payload: str) -> str:
+    return await jobs.run(Job(jobs, job_id, user_id, chat_id, kind, payload))
+
+async def _run_job_on_shard(job: Job) -> str:
+    """Исполнитель задач координатора: задача выполняется в шарде владельца."""
+    return await router.call(job.user_id, "job", job.id, job.user_id, job.chat_id, job.kind,
+                             json.dumps(job.payload, ensure_ascii=False))
+
+# Операции с клиентами UserBot, доступные через _userbot_call
+SHARD_HANDLERS = {
+    "job": _shard_job,
+    "status": _account_status,
+    "discard": utils.userbot_pool.discard,
+}
+
+def _userbot_background(shard: tuple = None) -> list:
+    """Фоновые задачи процесса, которому принадлежат клиенты UserBot."""
+    background = [asyncio.create_task(utils.userbot_pool.run_sweeper())]
+    if utils.HEALTH_CHECK_INTERVAL > 0:
+        background.append(asyncio.create_task(utils.run_health_checker(db)))
+    if utils.WARMUP_ENABLED:
+        # Прогрев идет в фоне: опрос обновлений начинается сразу
+        background.append(asyncio.create_task(utils.warm_up_pool(db, shard=shard)))
+    return background
+
+async def _shard_main(shard_id: int, shards_total: int, conn):
+    logging.info(f"Шард {shard_id}/{shards_total}: pid {os.getpid()}")
+    background = _userbot_background((shard_id, shards_total))
+    if loopmon.LOOP_DEBUG:
+        background.append(asyncio.create_task(loopmon.LoopMonitor(label=f"shard-{shard_id}").run()))
+    try:
+        await shards.serve(conn, SHARD_HANDLERS)
+    finally:
+        for task in background:
+            task.cancel()
+        await utils.userbot_pool.close()
+        await db.close()
+
+def _run_shard(shard_id: int, shards_total: int, conn):
+    """Точка входа процесса-шарда."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # остановкой шардов управляет координатор
+    asyncio.run(_shard_main(shard_id, shards_total, conn))
+
 async def main():
     """Основная функция для запуска бота."""
+    global router
     logging.info("Запуск управляющего бота...")
     await set_bot_commands(bot)
-    await dp.start_polling(bot)
+    background = [
+        asyncio.create_task(fsm_storage.run_sweeper()),
+        asyncio.create_task(utils.pending_logins.run_sweeper()),
+    ]
+    if LOG_RETENTION_DAYS > 0:
+        background.append(asyncio.create_task(run_log_retention()))
+    if loopmon.LOOP_DEBUG:
+        background.append(asyncio.create_task(loopmon.LoopMonitor().run()))
+    if shards.SHARDS > 0:
+        router = shards.ShardRouter(shards.SHARDS, _run_shard)
+        await router.start()
+        jobs.executor = _run_job_on_shard
+        jobs.workers *= shards.SHARDS  # задачи выполняются в шардах параллельно
+    else:
+        background += _userbot_background()
+    metrics_runner = await metrics.start_server() if metrics.METRICS_ENABLED else None
+    await jobs.start()
+    try:
+        if webhook.BOT_MODE == "webhook":
+            await webhook.run_webhook(dp, bot)
+        else:
+            await bot.delete_webhook()  # опрос не работает, пока зарегистрирован webhook
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        for task in background:
+            task.cancel()
+        await jobs.stop()
+        if router is not None:
+            await router.close()
+        await utils.pending_logins.close()
+        await utils.userbot_pool.close()
+        await db.close()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logging.info("Бот остановлен.")
-    finally:
-        db.close()
@@ -0,0 +1,116 @@
+# jobs.py
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+JOB_WORKERS = int(os.getenv("USERBOT_JOB_WORKERS", "4"))
+
+
+class JobError(Exception):
+    """Ожидаемая ошибка задачи: текст уходит пользователю без трассировки."""
+
+
+class Job:
+    """Задача из таблицы jobs, передаваемая обработчику."""
+
+    def __init__(self, queue: "JobQueue", job_id: int, user_id: int, chat_id: int, kind: str, payload: str):
+        self.queue = queue
+        self.id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.kind = kind
+        self.payload = json.loads(payload)
+
+    async def progress(self, text: str):
+        """Сообщить пользователю о ходе выполнения."""
+        await self.queue.notify(self.chat_id, f"[#{self.id}] {text}")
+
+    async def checkpoint(self, **values):
+        """
+        Сохранить промежуточное состояние в payload, чтобы после перезапуска
+        задача продолжилась с этого места, а не повторяла сделанные шаги.
+        """
+        self.payload.update(values)
+        await self.queue.db.update_job_payload(self.id, json.dumps(self.payload, ensure_ascii=False))
+
+
+class JobQueue:
+    """
+    Постоянная очередь фоновых задач на таблице jobs.
+    Команды бота ставят задачу и сразу отвечают ее номером, а пул из workers
+    корутин выполняет задачи и присылает результат сообщением. Задачи,
+    выполнявшиеся в момент падения, при запуске возвращаются в очередь
+    (выполнение "как минимум один раз"; шаги защищаются через Job.checkpoint).
+    """
+
+    def __init__(self, db, notify: Callable[[int, str], Awaitable], workers: int = JOB_WORKERS):
+        self.db = db  # AsyncDatabase
+        self.notify = notify
+        self.workers = workers
+        self._handlers: dict[str, Callable[[Job], Awaitable[str]]] = {}
+        # Где выполнять задачу: по умолчанию run() в этом процессе (в режиме шардов - в шарде)
+        self.executor: Optional[Callable[[Job], Awaitable[str]]] = None
+        self._wakeups: asyncio.Queue = asyncio.Queue()  # по одному сигналу на каждую новую задачу
+        self._tasks: list[asyncio.Task] = []
+
+    def handler(self, kind: str):
+        """Декоратор регистрации обработчика задач вида kind. Обработчик возвращает текст результата."""
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    async def run(self, job: Job) -> str:
+        """Выполнить обработчик задачи в текущем процессе."""
+        return await self._handlers[job.kind](job)
+
+    async def enqueue(self, user_id: int, chat_id: int, kind: str, **payload) -> int:
+        """Поставить задачу в очередь; возвращает ее номер."""
+        if kind not in self._handlers:
+            raise ValueError(f"Неизвестный вид задачи: {kind}")
+        job_id = await self.db.enqueue_job(user_id, chat_id, kind, json.dumps(payload, ensure_ascii=False))
+        self._wakeups.put_nowait(None)
+        return job_id
+
+    async def start(self):
+        """Вернуть прерванные задачи в очередь и запустить обработчиков."""
+        resumed = await self.db.requeue_running_jobs()
+        if resumed:
+            logging.info(f"Возобновлено прерванных задач: {resumed}")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Остановить обработчиков; незавершенные задачи останутся в статусе running и возобновятся."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            row = await self.db.claim_job()
+            if row is None:
+                await self._wakeups.get()
+                continue
+            job = Job(self, *row)
+            try:
+                result = await (self.executor or self.run)(job)
+                await self.db.finish_job(job.id, "done", result)
+                await self._notify_safely(job, f"✅ Задача #{job.id} выполнена.\n{result}")
+            except asyncio.CancelledError:
+                raise
+            except JobError as e:
+                await self.db.finish_job(job.id, "failed", str(e))
+                await self._notify_safely(job, f"❌ Задача #{job.id}: {e}")
+            except Exception as e:
+                logging.exception(f"Задача #{job.id} ({job.kind}) завершилась ошибкой")
+                await self.db.finish_job(job.id, "failed", str(e))
+                await self._notify_safely(job, f"❌ Задача #{job.id} завершилась ошибкой: {e}")
+
+    async def _notify_safely(self, job: Job, text: str):
+        try:
+            await self.notify(job.chat_id, text)
+        except Exception:
+            logging.exception(f"Не удалось сообщить о результате задачи #{job.id}")
@@ -0,0 +1,62 @@
+# log_export.py
+import asyncio
+import csv
+import io
+import json
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
+
+EXPORT_FORMATS = ("csv", "jsonl")
+COLUMNS = ("id", "timestamp", "event_type", "message", "user_id", "chat_id", "outcome")
+
+
+def export_filename(fmt: str) -> str:
+    return f"logs.{fmt}.gz"
+
+
+def parse_day(value: str) -> int:
+    """Начало дня YYYY-MM-DD (местное время) в unix-времени; ValueError при другом формате."""
+    return int(time.mktime(time.strptime(value, "%Y-%m-%d")))
+
+
+def _encode_chunk(rows, fmt: str) -> str:
+    if fmt == "jsonl":
+        return "".join(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def _compressed_chunks(chunks, fmt: str):
+    """Сжать пачки строк в поток gzip; в памяти не больше одной пачки."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # 16 + MAX_WBITS - формат gzip
+    if fmt == "csv":
+        yield compressor.compress(_encode_chunk([COLUMNS], fmt).encode())
+    for rows in chunks:
+        data = compressor.compress(_encode_chunk(rows, fmt).encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def stream_logs(db, fmt: str = "csv", **filters) -> AsyncIterator[bytes]:
+    """
+    Выгрузка логов (фильтры как у Database.iter_logs) в gzip CSV или JSONL.
+    Чтение, кодирование и сжатие каждой пачки выполняются в отдельном потоке,
+    поэтому ни event loop, ни поток AsyncDatabase не заняты выгрузкой.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    chunks = _compressed_chunks(db.sync.iter_logs(**filters), fmt)
+    # Один поток: закрытие генератора выполнится только после текущей пачки
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-export")
+    loop = asyncio.get_running_loop()
+    try:
+        while (data := await loop.run_in_executor(executor, next, chunks, None)) is not None:
+            if data:
+                yield data
+    finally:
+        executor.submit(chunks.close)  # закрывает соединение для чтения
+        executor.shutdown(wait=False)
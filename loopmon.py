@@ -0,0 +1,123 @@
+# loopmon.py
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+# Режим отладки event loop и профилирование (можно переопределить переменными окружения)
+LOOP_DEBUG = os.getenv("USERBOT_LOOP_DEBUG", "0") == "1"
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("USERBOT_LOOP_LAG_THRESHOLD_MS", "100"))
+LOOP_LAG_INTERVAL = 0.05  # секунд между замерами задержки loop
+PROFILE_INTERVAL = 0.005  # секунд между выборками профайлера (200 Гц)
+PROFILE_MAX_SECONDS = 300
+# Telegram ID администраторов через запятую: им доступна команда /profile
+ADMIN_IDS = {int(x) for x in os.getenv("USERBOT_ADMIN_IDS", "").replace(",", " ").split()}
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _frame_label(frame) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+def _stack(frame) -> list:
+    """Кадры от внешнего к внутреннему."""
+    stack = []
+    while frame is not None:
+        stack.append(frame)
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _culprit(stack: list) -> str:
+    """Самый внутренний кадр кода проекта - обработчик или функция, заблокировавшая loop."""
+    for frame in reversed(stack):
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if os.path.dirname(filename) == PROJECT_DIR and filename != os.path.abspath(__file__):
+            return f"{_frame_label(frame)}:{frame.f_lineno}"
+    return "вне кода проекта"
+
+
+class LoopMonitor:
+    """
+    Отладка зависаний event loop:
+    - run() раз в LOOP_LAG_INTERVAL замеряет, насколько позже срока проснулась
+      корутина (задержка loop), и пишет замеры в userbot_loop_lag_seconds;
+    - сторожевой поток замечает, что loop не отвечает дольше порога, и пишет
+      в лог стек потока loop в момент зависания вместе с виновным кадром;
+    - asyncio в режиме отладки логирует callbacks дольше порога.
+    """
+
+    def __init__(self, threshold_ms: int = LOOP_LAG_THRESHOLD_MS, label: str = "main"):
+        self.threshold = threshold_ms / 1000
+        self.label = label
+        self.stalls = 0
+        self.max_lag = 0.0
+        self._heartbeat = time.monotonic()
+        self._stopped = threading.Event()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.threshold
+        watchdog = threading.Thread(target=self._watch, args=(threading.get_ident(),),
+                                    name="loop-watchdog", daemon=True)
+        watchdog.start()
+        logging.info(f"Мониторинг event loop включен, порог {self.threshold * 1000:.0f} мс")
+        try:
+            while True:
+                started = loop.time()
+                await asyncio.sleep(LOOP_LAG_INTERVAL)
+                lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+                self._heartbeat = time.monotonic()
+                self.max_lag = max(self.max_lag, lag)
+                metrics.loop_lag_seconds.observe(lag, self.label)
+        finally:
+            self._stopped.set()
+
+    def _watch(self, loop_thread_id: int):
+        reported = None  # heartbeat уже описанного зависания: одно зависание - одна запись
+        while not self._stopped.wait(self.threshold / 2):
+            beat = self._heartbeat
+            stalled = time.monotonic() - beat - LOOP_LAG_INTERVAL
+            if stalled < self.threshold or reported == beat:
+                continue
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is None:
+                continue
+            reported = beat
+            self.stalls += 1
+            logging.warning(
+                f"Event loop ({self.label}) не отвечает {stalled * 1000:.0f} мс, "
+                f"выполняется {_culprit(_stack(frame))}:\n" + "".join(traceback.format_stack(frame))
+            )
+
+
+def sample_profile(seconds: float, interval: float = PROFILE_INTERVAL) -> str:
+    """
+    Семплирующий профайлер всего процесса: каждые interval секунд снимает стеки
+    всех потоков (кроме своего). Запускается в отдельном потоке и не требует
+    трассировки, поэтому почти не замедляет бота. Возвращает collapsed stacks
+    ("поток;файл:функция;... число") для flamegraph.pl или speedscope.
+    """
+    counts = collections.Counter()
+    own_id = threading.get_ident()
+    names = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            if thread_id not in names:
+                names.update((t.ident, t.name) for t in threading.enumerate())
+            stack = ";".join(_frame_label(f) for f in _stack(frame))
+            counts[f"{names.get(thread_id, thread_id)};{stack}"] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
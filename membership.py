@@ -0,0 +1,108 @@
+# membership.py
+import asyncio
+import os
+import re
+import time
+from typing import Awaitable, Callable, NamedTuple, Optional
+from urllib.parse import parse_qs
+
+# Сколько секунд данные об участии и о том, куда ведет ссылка, считаются свежими
+MEMBERSHIP_TTL = int(os.getenv("USERBOT_MEMBERSHIP_TTL", "86400"))
+
+_WEB_LINK = re.compile(r"^(?:https?://)?(?:www\.)?(?:t|telegram)\.(?:me|dog)/(?P<path>[^?#]+)", re.IGNORECASE)
+_TG_LINK = re.compile(r"^tg://(?P<action>join|resolve)\?(?P<query>.+)$", re.IGNORECASE)
+_USERNAME = re.compile(r"^[A-Za-z][A-Za-z0-9_]{3,31}$")
+_INVITE_HASH = re.compile(r"^[A-Za-z0-9_-]+$")
+# Служебные пути t.me, которые не являются username чата
+_RESERVED_PATHS = {"c", "addlist", "addstickers", "addemoji", "share", "proxy", "socks", "login",
+                   "setlanguage", "bg", "invoice", "boost", "iv"}
+
+
+class ChatLink(NamedTuple):
+    """Разобранная ссылка на чат: kind - "username" или "invite"."""
+    kind: str
+    value: str  # username в нижнем регистре или хэш приглашения
+
+    @property
+    def key(self) -> str:
+        """Ключ ссылки для кэша: разные записи одной ссылки дают один ключ."""
+        return ("+" if self.kind == "invite" else "@") + self.value
+
+
+def _username(value: str) -> ChatLink:
+    if not _USERNAME.match(value) or value.lower() in _RESERVED_PATHS:
+        raise ValueError(f"некорректный username: {value}")
+    return ChatLink("username", value.lower())
+
+
+def _invite(value: str) -> ChatLink:
+    if not _INVITE_HASH.match(value):
+        raise ValueError(f"некорректный хэш приглашения: {value}")
+    return ChatLink("invite", value)
+
+
+def parse_link(text: str) -> ChatLink:
+    """
+    Разобрать ссылку на чат: t.me/username (а также telegram.me, t.me/s/username,
+    ссылки на сообщения t.me/username/123), @username, tg://resolve?domain=,
+    приглашения t.me/+hash, t.me/joinchat/hash и tg://join?invite=.
+    ValueError, если ссылка не ведет на чат, в который можно вступить.
+    """
+    text = text.strip()
+    if text.startswith("@"):
+        return _username(text[1:])
+    if match := _TG_LINK.match(text):
+        query = parse_qs(match["query"])
+        if match["action"].lower() == "join":
+            return _invite(query.get("invite", [""])[0])
+        return _username(query.get("domain", [""])[0])
+    if match := _WEB_LINK.match(text):
+        segments = [s for s in match["path"].split("/") if s]
+        if not segments:
+            raise ValueError("пустая ссылка")
+        first = segments[0]
+        if first.startswith("+"):
+            return _invite(first[1:])
+        if first.lower() in ("joinchat", "s") and len(segments) > 1:
+            return _invite(segments[1]) if first.lower() == "joinchat" else _username(segments[1])
+        return _username(first)
+    return _username(text)
+
+
+class MembershipCache:
+    """
+    Кэш участия аккаунтов в чатах, хранимый в SQLite: (аккаунт, чат) -> участник
+    (таблица memberships) и ссылка -> чат (таблица chat_links). Заполняется при
+    /scan и после успешных вступлений; записи старше ttl считаются неизвестными,
+    и участие проверяется заново запросом к Telegram.
+    Одновременные вступления аккаунта по одной ссылке выполняются один раз.
+    """
+
+    def __init__(self, db, ttl: int = MEMBERSHIP_TTL):
+        self.db = db  # AsyncDatabase
+        self.ttl = ttl
+        self._inflight: dict[tuple, asyncio.Future] = {}
+
+    async def member_chat(self, account_id: int, link: ChatLink) -> Optional[int]:
+        """chat_id, если аккаунт по свежим данным состоит в чате по ссылке, иначе None."""
+        return await self.db.get_link_membership(account_id, link.key, int(time.time()) - self.ttl)
+
+    async def remember(self, account_id: int, chat_id: int, link: ChatLink = None):
+        """Записать участие аккаунта в чате и, если задана, ссылку на этот чат."""
+        await self.db.add_memberships(account_id, [chat_id], [(link.key, chat_id)] if link else [])
+
+    async def single_flight(self, account_id: int, link: ChatLink, func: Callable[[], Awaitable]):
+        """
+        Выполнить func() для (аккаунт, ссылка) один раз: вызовы, пришедшие,
+        пока он выполняется, получают тот же результат.
+        """
+        key = (account_id, link.key)
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)  # отмена одного ожидающего не отменяет вступление
+
+
+# Кэш участия; подключается при запуске бота (index.py)
+cache: "MembershipCache | None" = None
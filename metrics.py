@@ -0,0 +1,149 @@
+# metrics.py
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Callable
+
+# Метрики выключены по умолчанию: тогда таймеры не создаются и обертки возвращают исходные объекты
+METRICS_ENABLED = os.getenv("USERBOT_METRICS", "0") == "1"
+METRICS_HOST = os.getenv("USERBOT_METRICS_HOST", "127.0.0.1")  # 0.0.0.0 - для Prometheus на другой машине
+METRICS_PORT = int(os.getenv("USERBOT_METRICS_PORT", "9100"))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus с метками."""
+
+    def __init__(self, name: str, help_text: str, label: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series: dict[str, list] = {}  # значение метки -> [счетчики по корзинам, сумма, количество]
+        self._lock = threading.Lock()  # наблюдения приходят и из event loop, и из потока БД
+
+    def observe(self, value: float, label_value: str):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+        for label_value, (counts, total, count) in sorted(snapshot.items()):
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+handler_seconds = Histogram("userbot_handler_seconds", "Время обработки апдейта обработчиком aiogram", "handler")
+rpc_seconds = Histogram("userbot_rpc_seconds", "Время вызовов Telethon из utils.py", "method")
+db_lock_wait_seconds = Histogram("userbot_db_lock_wait_seconds", "Ожидание Database.lock", "query")
+db_query_seconds = Histogram("userbot_db_query_seconds", "Время запроса под Database.lock", "query")
+loop_lag_seconds = Histogram("userbot_loop_lag_seconds", "Задержка event loop (USERBOT_LOOP_DEBUG)", "process")
+
+_histograms = [handler_seconds, rpc_seconds, db_lock_wait_seconds, db_query_seconds, loop_lag_seconds]
+_gauges: list[tuple[str, str, Callable[[], float]]] = []
+
+
+def register_gauge(name: str, help_text: str, func: Callable[[], float]):
+    """Значение, вычисляемое в момент запроса /metrics (размер пула и т.п.)."""
+    _gauges.append((name, help_text, func))
+
+
+def render() -> str:
+    lines = []
+    for histogram in _histograms:
+        lines.extend(histogram.render())
+    for name, help_text, func in _gauges:
+        lines.extend((f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {func()}"))
+    return "\n".join(lines) + "\n"
+
+
+def timed(method: str, func: Callable) -> Callable:
+    """Обертка асинхронного вызова Telethon, замеряющая его время (без метрик - сам func)."""
+    if not METRICS_ENABLED:
+        return func
+
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            rpc_seconds.observe(time.perf_counter() - start, method)
+    return wrapper
+
+
+class InstrumentedLock:
+    """
+    threading.Lock, замеряющий ожидание и удержание блокировки.
+    Метка - имя метода Database, взявшего блокировку.
+    """
+
+    def __init__(self, lock: threading.Lock):
+        self._lock = lock
+        self._query = None
+        self._acquired_at = 0.0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        self._query = sys._getframe(1).f_code.co_name
+        db_lock_wait_seconds.observe(self._acquired_at - start, self._query)
+        return self
+
+    def __exit__(self, *exc):
+        db_query_seconds.observe(time.perf_counter() - self._acquired_at, self._query)
+        self._lock.release()
+        return False
+
+
+def instrument_lock(lock: threading.Lock):
+    return InstrumentedLock(lock) if METRICS_ENABLED else lock
+
+
+class HandlerTimingMiddleware:
+    """Middleware aiogram: время каждого обработчика по имени его функции."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else type(event).__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, name)
+
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """HTTP-сервер с /metrics в формате Prometheus. Возвращает runner для остановки."""
+    from aiohttp import web
+
+    async def metrics_handler(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
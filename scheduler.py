@@ -0,0 +1,213 @@
+# scheduler.py
+import asyncio
+import logging
+import os
+import time
+import weakref
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from telethon import TelegramClient, errors
+
+# Лимиты по типам операций: (операций в минуту, размер всплеска).
+# Пока аккаунт простаивает, накопленные токены позволяют выполнить запрос сразу.
+RATE_LIMITS = {
+    "join": (float(os.getenv("USERBOT_RATE_JOIN_PER_MIN", "12")), int(os.getenv("USERBOT_RATE_JOIN_BURST", "2"))),
+    "send": (float(os.getenv("USERBOT_RATE_SEND_PER_MIN", "20")), int(os.getenv("USERBOT_RATE_SEND_BURST", "3"))),
+}
+MAX_ATTEMPTS = int(os.getenv("USERBOT_MAX_ATTEMPTS", "3"))
+MAX_FLOOD_WAIT = int(os.getenv("USERBOT_MAX_FLOOD_WAIT", "900"))  # дольше этого не ждем, а сообщаем об ошибке
+FLOOD_WAIT_MARGIN = 5  # секунд запаса сверх указанного Telegram
+COOLDOWN_CACHE_SIZE = 10000  # сроков ожидания в памяти; давно не использованные вытесняются
+ACCOUNT_SCHEDULERS_MAX = 1000  # сверх этого простаивающие планировщики аккаунтов удаляются
+
+
+class CooldownError(Exception):
+    """Ожидание дольше MAX_FLOOD_WAIT: операцию нужно повторить позже."""
+
+    def __init__(self, seconds: float):
+        super().__init__(f"нужно подождать {int(seconds)} с")
+        self.seconds = int(seconds)
+
+
+class CooldownStore:
+    """
+    Сроки ожидания (аккаунт, чат, операция) -> deadline, сохраняемые в SQLite,
+    чтобы FloodWait и антиспам-задержки переживали перезапуск.
+    Чтение идет через кэш в памяти (LRU, не больше max_entries записей);
+    истекшие сроки удаляются из кэша при обращении.
+    """
+    ACCOUNT = "*"  # chat для ограничений на весь аккаунт
+
+    def __init__(self, db, max_entries: int = COOLDOWN_CACHE_SIZE):
+        self.db = db  # AsyncDatabase
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[tuple, float]" = OrderedDict()  # от давно использованных к свежим
+
+    def _remember(self, key: tuple, deadline: float):
+        self._cache[key] = deadline
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def deadline(self, account_id: int, chat, operation: str) -> float:
+        """Срок окончания ожидания (time.time()) или 0."""
+        key = (account_id, str(chat), operation)
+        deadline = self._cache.get(key)
+        if deadline is None:
+            deadline = await self.db.get_cooldown(*key)
+            self._remember(key, deadline)
+        else:
+            self._cache.move_to_end(key)
+        if deadline and deadline <= time.time():
+            self._cache.pop(key, None)
+            return 0.0
+        return deadline
+
+    async def remaining(self, account_id: int, chat, operation: str) -> float:
+        """Сколько секунд осталось ждать (0 - можно выполнять)."""
+        return max(0.0, await self.deadline(account_id, chat, operation) - time.time())
+
+    async def set(self, account_id: int, chat, operation: str, seconds: float):
+        key = (account_id, str(chat), operation)
+        deadline = time.time() + seconds
+        self._remember(key, max(deadline, self._cache.get(key) or 0.0))
+        await self.db.set_cooldown(*key, deadline)
+
+
+# Хранилище сроков ожидания; подключается при запуске бота (index.py)
+cooldowns: "CooldownStore | None" = None
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше burst накопленных."""
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()  # ожидающие получают токены по очереди
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def full(self) -> bool:
+        """Все токены накоплены и никто не ждет."""
+        self._refill()
+        return self.tokens >= self.burst and not self._lock.locked()
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class AccountScheduler:
+    """
+    Планировщик запросов одного аккаунта UserBot.
+    Каждая операция ждет токен своего типа; FloodWait на любой операции
+    приостанавливает всю очередь аккаунта до срока, указанного Telegram.
+    """
+
+    def __init__(self, account_id=None, limits: dict = None):
+        self.account_id = account_id
+        self.paused_until = 0.0  # time.time(), до которого аккаунт ничего не отправляет
+        self._buckets = {op: TokenBucket(*cfg) for op, cfg in (limits or RATE_LIMITS).items()}
+
+    def idle(self) -> bool:
+        """Нет паузы и лимиты не израсходованы: планировщик не отличается от нового."""
+        return self.paused_until <= time.time() and all(b.full() for b in self._buckets.values())
+
+    @property
+    def persistent(self) -> bool:
+        return cooldowns is not None and self.account_id is not None
+
+    async def pause(self, seconds: float, chat=None, operation: str = None):
+        """
+        Приостановить операции на seconds секунд: все операции аккаунта
+        или, если задан chat, только operation в этом чате (медленный режим).
+        """
+        if chat is None:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            chat, operation = CooldownStore.ACCOUNT, "flood"
+        if self.persistent:
+            await cooldowns.set(self.account_id, chat, operation, seconds)
+
+    async def remaining(self, chat=None, operation: str = None) -> float:
+        """Сколько секунд аккаунт (и чат, если задан) еще должен ждать."""
+        deadline = self.paused_until
+        if self.persistent:
+            deadline = max(deadline, await cooldowns.deadline(self.account_id, CooldownStore.ACCOUNT, "flood"))
+            if chat is not None:
+                deadline = max(deadline, await cooldowns.deadline(self.account_id, chat, operation))
+        return deadline - time.time()
+
+    async def wait_ready(self, chat=None, operation: str = None):
+        """Дождаться окончания пауз; ожидание дольше MAX_FLOOD_WAIT - CooldownError."""
+        while (delay := await self.remaining(chat, operation)) > 0:
+            if delay > MAX_FLOOD_WAIT:
+                raise CooldownError(delay)
+            await asyncio.sleep(delay)
+
+    async def run(self, operation: str, func: Callable[..., Awaitable], *args, chat=None):
+        """
+        Выполнить func(*args) с учетом лимита operation и пауз аккаунта и чата chat.
+        При FloodWait / SlowModeWait повторяет до MAX_ATTEMPTS раз; если попытки
+        кончились или ожидание дольше MAX_FLOOD_WAIT, пробрасывает ошибку Telethon.
+        """
+        bucket = self._buckets.get(operation)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await self.wait_ready(chat, operation)
+            if bucket is not None:
+                await bucket.acquire()
+                await self.wait_ready(chat, operation)  # пауза могла начаться, пока ждали токен
+            try:
+                return await func(*args)
+            except errors.FloodWaitError as e:
+                await self.pause(e.seconds + FLOOD_WAIT_MARGIN)
+                logging.warning(f"FloodWait {e.seconds} с для аккаунта {self.account_id} "
+                                f"({operation}, попытка {attempt}/{MAX_ATTEMPTS})")
+                if attempt == MAX_ATTEMPTS or e.seconds > MAX_FLOOD_WAIT:
+                    raise
+            except errors.SlowModeWaitError as e:
+                if chat is None:
+                    raise
+                await self.pause(e.seconds + FLOOD_WAIT_MARGIN, chat, operation)
+                logging.warning(f"Медленный режим {e.seconds} с в чате {chat} для аккаунта {self.account_id}")
+                if attempt == MAX_ATTEMPTS or e.seconds > MAX_FLOOD_WAIT:
+                    raise
+
+
+# Планировщики по аккаунтам переживают переподключение клиента в пуле
+_account_schedulers: dict = {}
+_client_schedulers: "weakref.WeakKeyDictionary[TelegramClient, AccountScheduler]" = weakref.WeakKeyDictionary()
+
+def _prune_schedulers():
+    """Удалить простаивающие планировщики аккаунтов без подключенных клиентов."""
+    in_use = {id(scheduler) for scheduler in _client_schedulers.values()}
+    for account_id, scheduler in list(_account_schedulers.items()):
+        if id(scheduler) not in in_use and scheduler.idle():
+            del _account_schedulers[account_id]
+
+def bind(client: TelegramClient, account_id) -> AccountScheduler:
+    """Привязать клиент к планировщику аккаунта account_id."""
+    scheduler = _account_schedulers.get(account_id)
+    if scheduler is None:
+        if len(_account_schedulers) >= ACCOUNT_SCHEDULERS_MAX:
+            _prune_schedulers()
+        scheduler = _account_schedulers[account_id] = AccountScheduler(account_id)
+    _client_schedulers[client] = scheduler
+    return scheduler
+
+def for_client(client: TelegramClient) -> AccountScheduler:
+    """Планировщик клиента; для непривязанного клиента создается собственный."""
+    scheduler = _client_schedulers.get(client)
+    if scheduler is None:
+        scheduler = _client_schedulers[client] = AccountScheduler()
+    return scheduler
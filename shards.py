@@ -0,0 +1,198 @@
+# shards.py
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+from typing import Awaitable, Callable
+
+from jobs import JobError
+
+# Число процессов-шардов с клиентами UserBot; 0 - все в одном процессе
+SHARDS = int(os.getenv("USERBOT_SHARDS", "0"))
+SHARD_RESTART_DELAY = 1.0  # секунд до перезапуска упавшего шарда
+SHARD_STOP_TIMEOUT = 10.0  # секунд на штатную остановку шарда
+
+
+class ShardError(Exception):
+    """Шард недоступен (перезапускается) или упал во время вызова."""
+
+
+class RemoteError(Exception):
+    """Исключение, возникшее в шарде; исходный класс сохраняется в type_name."""
+
+    def __init__(self, type_name: str, message: str):
+        super().__init__(f"{type_name}: {message}" if message else type_name)
+        self.type_name = type_name
+
+
+def shard_of(user_id: int, shards: int) -> int:
+    """Номер шарда, которому принадлежат клиенты user_id."""
+    return user_id % shards
+
+
+def _remote_exception(type_name: str, message: str) -> Exception:
+    # JobError - ожидаемая ошибка задачи, ее текст показывается пользователю как есть
+    return JobError(message) if type_name == "JobError" else RemoteError(type_name, message)
+
+
+class _Shard:
+    __slots__ = ("id", "process", "conn", "pending")
+
+    def __init__(self, shard_id: int):
+        self.id = shard_id
+        self.process = None
+        self.conn = None  # None - шард перезапускается
+        self.pending: dict[int, asyncio.Future] = {}
+
+
+class ShardRouter:
+    """
+    Координатор шардов: запускает shards процессов target(shard_id, shards, conn)
+    и направляет вызовы в процесс, которому принадлежит user_id.
+    Обмен идет через multiprocessing.Pipe сообщениями (call_id, method, args) ->
+    (call_id, ok, result). Упавший шард перезапускается, а его незавершенные
+    вызовы завершаются ShardError; остальные шарды и бот продолжают работу.
+    """
+
+    def __init__(self, shards: int, target: Callable):
+        self.shards = shards
+        self.target = target
+        self.restarts = 0
+        self._ctx = multiprocessing.get_context("spawn")  # fork небезопасен при работающем event loop
+        self._shards = [_Shard(shard_id) for shard_id in range(shards)]
+        self._call_ids = itertools.count(1)
+        self._closing = False
+        self._restarting: set[asyncio.Task] = set()  # задачи перезапуска упавших шардов
+
+    async def start(self):
+        for shard in self._shards:
+            self._spawn(shard)
+
+    def _spawn(self, shard: _Shard):
+        if self._closing:
+            return
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=self.target, args=(shard.id, self.shards, child_conn),
+                                    name=f"userbot-shard-{shard.id}", daemon=True)
+        process.start()
+        child_conn.close()  # иначе чтение не получит EOF, когда шард упадет
+        shard.process, shard.conn = process, parent_conn
+        asyncio.get_running_loop().add_reader(parent_conn.fileno(), self._on_readable, shard)
+        logging.info(f"Шард {shard.id} запущен (pid {process.pid})")
+
+    def _on_readable(self, shard: _Shard):
+        try:
+            while shard.conn.poll():
+                call_id, ok, result = shard.conn.recv()
+                future = shard.pending.pop(call_id, None)
+                if future is None or future.done():
+                    continue
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(_remote_exception(*result))
+        except (EOFError, OSError):
+            self._on_crash(shard)
+
+    def _detach(self, shard: _Shard, reason: str):
+        """Отключить канал шарда и завершить его незавершенные вызовы ошибкой."""
+        if shard.conn is not None:
+            asyncio.get_running_loop().remove_reader(shard.conn.fileno())
+            shard.conn.close()
+            shard.conn = None
+        for future in shard.pending.values():
+            if not future.done():
+                future.set_exception(ShardError(reason))
+        shard.pending.clear()
+
+    def _on_crash(self, shard: _Shard):
+        self._detach(shard, f"Шард {shard.id} завершился во время выполнения, повторите позже")
+        task = asyncio.get_running_loop().create_task(self._restart(shard))
+        self._restarting.add(task)
+        task.add_done_callback(self._restarting.discard)
+
+    async def _restart(self, shard: _Shard):
+        # Канал закрыт - процесс уже завершается; join блокирует, поэтому ждем его в потоке
+        await asyncio.get_running_loop().run_in_executor(None, shard.process.join, 0.1)
+        if shard.process.is_alive():
+            shard.process.terminate()
+        if self._closing:
+            return
+        self.restarts += 1
+        logging.error(f"Шард {shard.id} упал (код {shard.process.exitcode}), перезапуск через {SHARD_RESTART_DELAY} с")
+        await asyncio.sleep(SHARD_RESTART_DELAY)
+        self._spawn(shard)
+
+    async def call(self, user_id: int, method: str, *args):
+        """Выполнить обработчик method(*args) в шарде, которому принадлежит user_id."""
+        shard = self._shards[shard_of(user_id, self.shards)]
+        if shard.conn is None:
+            raise ShardError(f"Шард {shard.id} перезапускается, повторите позже")
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        shard.pending[call_id] = future
+        try:
+            shard.conn.send((call_id, method, args))
+        except (OSError, ValueError):
+            shard.pending.pop(call_id, None)
+            raise ShardError(f"Шард {shard.id} недоступен, повторите позже")
+        return await future
+
+    async def close(self):
+        """Остановить шарды: закрытый канал - сигнал шарду завершить работу и отключить клиентов."""
+        self._closing = True
+        loop = asyncio.get_running_loop()
+        for task in list(self._restarting):
+            task.cancel()
+        await asyncio.gather(*self._restarting, return_exceptions=True)
+        for shard in self._shards:
+            self._detach(shard, "Бот останавливается")
+        for shard in self._shards:
+            if shard.process is None:
+                continue
+            await loop.run_in_executor(None, shard.process.join, SHARD_STOP_TIMEOUT)
+            if shard.process.is_alive():
+                logging.warning(f"Шард {shard.id} не остановился за {SHARD_STOP_TIMEOUT} с, принудительное завершение")
+                shard.process.terminate()
+
+
+async def serve(conn, handlers: dict[str, Callable[..., Awaitable]]):
+    """
+    Цикл шарда: выполнять вызовы координатора, каждый в отдельной задаче,
+    пока координатор не закроет канал.
+    """
+    loop = asyncio.get_running_loop()
+    closed = loop.create_future()
+    tasks: set[asyncio.Task] = set()
+
+    async def handle(call_id: int, method: str, args: tuple):
+        try:
+            reply = (call_id, True, await handlers[method](*args))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            reply = (call_id, False, (type(e).__name__, str(e)))
+        try:
+            conn.send(reply)
+        except (OSError, ValueError):
+            pass  # координатор уже закрыл канал
+        except Exception as e:  # результат не сериализуется
+            conn.send((call_id, False, (type(e).__name__, str(e))))
+
+    def on_readable():
+        try:
+            while conn.poll():
+                task = asyncio.create_task(handle(*conn.recv()))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (EOFError, OSError):
+            loop.remove_reader(conn.fileno())
+            if not closed.done():
+                closed.set_result(None)
+
+    loop.add_reader(conn.fileno(), on_readable)
+    await closed
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("telethon")
+
+from telethon.sessions import MemorySession
+
+import tg_session
+from db import Database
+
+AUTH_KEY = bytes(range(256))
+
+
+class RecordingDb:
+    """Замена AsyncDatabase: запоминает отложенные записи."""
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, name, *args):
+        self.calls.append((name, args))
+
+
+def test_clone_returns_memory_session_with_auth_data():
+    db = RecordingDb()
+    session = tg_session.DbSession(db, 1, "origin", (2, "149.154.167.40", 443, AUTH_KEY), [], [])
+
+    cloned = session.clone()
+
+    assert type(cloned) is MemorySession
+    assert (cloned.dc_id, cloned.server_address, cloned.port) == (2, "149.154.167.40", 443)
+    assert cloned.auth_key.key == AUTH_KEY
+    cloned.set_dc(4, "149.154.167.91", 443)
+    assert session.dc_id == 2
+    assert db.calls == []
+
+
+def test_login_after_logout_ignores_late_flush(tmp_path):
+    db = Database(str(tmp_path / "userbot.db"))
+    try:
+        session_row = (2, "149.154.167.40", 443, AUTH_KEY)
+        db.save_tg_session(1, "old", session_row, [(10, 111, "chat", None, "Chat")], [(0, 5, 0, 100, 1)])
+        db.delete_session(1)
+        # Клиент отключился уже после выхода и дописал кэш без строки сессии
+        db.save_tg_session(1, "old", None, [(10, 111, "chat", None, "Chat")], [(0, 6, 0, 200, 2)])
+
+        assert db.load_tg_session(1, "new") == (None, [], [])
+        assert db.load_tg_session(1, "old") == (None, [], [])
+    finally:
+        db.close()
@@ -0,0 +1,183 @@
+# tg_session.py
+import asyncio
+import os
+from datetime import datetime, timezone
+from typing import Optional
+
+from telethon import utils as tl_utils
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession, StringSession
+from telethon.tl import types
+
+# Пакетная запись изменений сессии: не чаще раза в TG_SESSION_FLUSH_INTERVAL секунд
+# или сразу, как только накопилось TG_SESSION_FLUSH_ENTITIES сущностей
+TG_SESSION_FLUSH_INTERVAL = float(os.getenv("USERBOT_TG_SESSION_FLUSH_INTERVAL", "5"))
+TG_SESSION_FLUSH_ENTITIES = 500
+
+# База для сессий Telethon (AsyncDatabase); подключается при запуске бота (index.py).
+# Без нее клиенты работают на StringSession, как раньше
+db = None
+
+
+class DbSession(MemorySession):
+    """
+    Сессия Telethon в таблицах tg_sessions / tg_entities / tg_update_state общей базы.
+    Сущности (хэши доступа) и состояние обновлений переживают перезапуск, поэтому
+    get_entity по username или id после перезапуска не требует ResolveUsername
+    и GetDialogs. Поиск идет по словарям в памяти, а изменения копятся и
+    записываются одной транзакцией в потоке БД, не блокируя event loop.
+    """
+
+    def __init__(self, database, account_id: int, origin: str, session_row, entities, states):
+        super().__init__()
+        self._db = database
+        self.account_id = account_id
+        self.origin = origin
+        self._by_id: dict[int, tuple] = {}
+        self._by_username: dict[str, int] = {}
+        self._by_phone: dict[str, int] = {}
+        self._session_dirty = False
+        self._dirty_entities: dict[int, tuple] = {}
+        self._dirty_states: dict[int, tuple] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+        if session_row is not None:
+            self._dc_id, self._server_address, self._port, auth_key = session_row
+            self._auth_key = AuthKey(auth_key) if auth_key else None
+        elif origin:
+            # Первое подключение после перехода с StringSession: переносим ключ авторизации
+            imported = StringSession(origin)
+            self._dc_id, self._server_address, self._port = imported.dc_id, imported.server_address, imported.port
+            self._auth_key = imported.auth_key
+            self._session_dirty = True
+        for row in entities:
+            self._index(row)
+        for entity_id, pts, qts, date, seq in states:
+            self._update_states[entity_id] = types.updates.State(
+                pts=pts, qts=qts, date=datetime.fromtimestamp(date, tz=timezone.utc), seq=seq, unread_count=0)
+
+    # --- ключ авторизации и дата-центр ---
+
+    @property
+    def auth_key(self):
+        return self._auth_key
+
+    @auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._session_dirty = True
+        self._schedule_flush()
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._session_dirty = True
+        self._schedule_flush()
+
+    # --- состояние обновлений ---
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        self._dirty_states[entity_id] = (state.pts, state.qts, int(state.date.timestamp()), state.seq)
+        self._schedule_flush()
+
+    # --- сущности ---
+
+    def _index(self, row: tuple):
+        entity_id, _, username, phone, _ = row
+        self._by_id[entity_id] = row
+        if username:
+            self._by_username[username] = entity_id
+        if phone:
+            self._by_phone[phone] = entity_id
+
+    def process_entities(self, tlo):
+        changed = False
+        for row in self._entities_to_rows(tlo):
+            if self._by_id.get(row[0]) != row:
+                self._index(row)
+                self._dirty_entities[row[0]] = row
+                changed = True
+        if changed:
+            self._schedule_flush()
+
+    def get_entity_rows_by_phone(self, phone):
+        entity_id = self._by_phone.get(phone)
+        return (entity_id, self._by_id[entity_id][1]) if entity_id is not None else None
+
+    def get_entity_rows_by_username(self, username):
+        entity_id = self._by_username.get(username)
+        return (entity_id, self._by_id[entity_id][1]) if entity_id is not None else None
+
+    def get_entity_rows_by_name(self, name):
+        return next(((row[0], row[1]) for row in self._by_id.values() if row[4] == name), None)
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        candidates = (id,) if exact else (
+            tl_utils.get_peer_id(types.PeerUser(id)),
+            tl_utils.get_peer_id(types.PeerChat(id)),
+            tl_utils.get_peer_id(types.PeerChannel(id)),
+        )
+        for entity_id in candidates:
+            row = self._by_id.get(entity_id)
+            if row is not None:
+                return entity_id, row[1]
+        return None
+
+    # --- запись ---
+
+    def _schedule_flush(self):
+        if len(self._dirty_entities) >= TG_SESSION_FLUSH_ENTITIES:
+            self._flush()
+        elif self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return  # вне event loop изменения запишет save()
+            self._flush_handle = loop.call_later(TG_SESSION_FLUSH_INTERVAL, self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not (self._session_dirty or self._dirty_entities or self._dirty_states):
+            return
+        session_row = None
+        if self._session_dirty:
+            auth_key = self._auth_key.key if self._auth_key else None
+            session_row = (self._dc_id, self._server_address, self._port, auth_key)
+        self._db.submit("save_tg_session", self.account_id, self.origin, session_row,
+                        list(self._dirty_entities.values()),
+                        [(entity_id, *state) for entity_id, state in self._dirty_states.items()])
+        self._session_dirty = False
+        self._dirty_entities = {}
+        self._dirty_states = {}
+
+    def clone(self, to_instance=None):
+        """
+        Копия ключа и дата-центра в памяти для вспомогательных клиентов Telethon
+        (CDN, экспорт файлов): они не должны писать в сессию аккаунта.
+        """
+        cloned = to_instance or MemorySession()
+        cloned.set_dc(self._dc_id, self._server_address, self._port)
+        cloned.auth_key = self._auth_key
+        return cloned
+
+    def save(self):
+        """Записать накопленные изменения (Telethon вызывает при смене ключа и отключении)."""
+        self._flush()
+
+    def close(self):
+        self._flush()
+
+    def delete(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._dirty_entities, self._dirty_states, self._session_dirty = {}, {}, False
+        self._db.submit("delete_tg_session", self.account_id)
+
+
+async def load(account_id: int, origin: Optional[str]) -> DbSession:
+    """Сессия аккаунта из базы (чтение в потоке БД); при первом запуске - импорт из origin."""
+    session_row, entities, states = await db.load_tg_session(account_id, origin)
+    return DbSession(db, account_id, origin, session_row, entities, states)
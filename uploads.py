@@ -0,0 +1,73 @@
+# uploads.py
+import asyncio
+import hashlib
+import io
+import os
+from typing import NamedTuple, Optional
+
+from telethon.tl import types
+
+# Сколько загруженных файлов помнить на аккаунт; сверх этого вытесняются давно не использованные
+UPLOAD_CACHE_SIZE = int(os.getenv("USERBOT_UPLOAD_CACHE_SIZE", "500"))
+
+
+class Attachment(NamedTuple):
+    """Вложение для отправки: kind - "photo" или "document"."""
+    kind: str
+    data: bytes
+    name: str
+
+    def as_file(self) -> io.BytesIO:
+        """Файл для загрузки через Telethon (имя файла берется из атрибута name)."""
+        file = io.BytesIO(self.data)
+        file.name = self.name
+        return file
+
+
+async def content_hash(data: bytes) -> str:
+    """sha256 содержимого; большие файлы хэшируются в потоке, не задерживая event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, lambda: hashlib.sha256(data).hexdigest())
+
+
+def media_ref(media) -> Optional[tuple]:
+    """(media_id, access_hash, file_reference) загруженного файла из message.media или None."""
+    if isinstance(media, types.MessageMediaPhoto) and isinstance(media.photo, types.Photo):
+        item = media.photo
+    elif isinstance(media, types.MessageMediaDocument) and isinstance(media.document, types.Document):
+        item = media.document
+    else:
+        return None
+    return item.id, item.access_hash, item.file_reference
+
+
+class UploadCache:
+    """
+    Файлы, уже загруженные аккаунтом в Telegram: (аккаунт, sha256, тип) ->
+    ссылка на файл (id, access_hash, file_reference), хранимая в SQLite (таблица uploads).
+    Повторная отправка того же содержимого идет по ссылке без загрузки файла.
+    На аккаунт хранится не больше max_entries ссылок, лишние вытесняются по LRU.
+    """
+
+    def __init__(self, db, max_entries: int = UPLOAD_CACHE_SIZE):
+        self.db = db  # AsyncDatabase
+        self.max_entries = max_entries
+
+    async def get(self, account_id: int, digest: str, kind: str):
+        """InputPhoto / InputDocument для повторной отправки или None."""
+        row = await self.db.get_upload(account_id, digest, kind)
+        if row is None:
+            return None
+        return (types.InputPhoto if kind == "photo" else types.InputDocument)(*row)
+
+    async def put(self, account_id: int, digest: str, kind: str, media):
+        """Запомнить файл из отправленного сообщения (message.media)."""
+        ref = media_ref(media)
+        if ref is not None:
+            await self.db.put_upload(account_id, digest, kind, ref, self.max_entries)
+
+    async def forget(self, account_id: int, digest: str, kind: str):
+        await self.db.delete_upload(account_id, digest, kind)
+
+
+# Кэш загрузок; подключается при запуске бота (index.py)
+cache: "UploadCache | None" = None
@@ -1,30 +1,295 @@
 # utils.py
 import asyncio
 import logging
+import os
+import time
+from collections import OrderedDict
 from telethon import TelegramClient, errors
 from telethon.sessions import StringSession
 from telethon.tl.functions.channels import JoinChannelRequest, GetParticipantRequest
-from telethon.tl.functions.messages import ImportChatInviteRequest
-from typing import Optional
+from telethon.tl.functions.messages import CheckChatInviteRequest, ImportChatInviteRequest
+from telethon.tl.types import ChatInviteAlready
+from typing import Awaitable, Callable, Optional
 import random
 from telethon.errors.rpcerrorlist import UserNotParticipantError
 
+import membership
+import metrics
+import scheduler
+import tg_session
+import uploads
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Глобальный словарь для хранения активных клиентов UserBot {user_id: client}
-userbot_clients = {}
+# Параметры пула клиентов UserBot (можно переопределить переменными окружения)
+POOL_MAX_CLIENTS = int(os.getenv("USERBOT_POOL_MAX_CLIENTS", "200"))
+POOL_IDLE_TIMEOUT = int(os.getenv("USERBOT_POOL_IDLE_TIMEOUT", "900"))  # секунд
+POOL_SWEEP_INTERVAL = 60  # секунд между проверками простаивающих клиентов
 
-async def get_userbot_client(user_id: int, api_id: int, api_hash: str, session_string: Optional[str] = None) -> TelegramClient:
+
+class _PoolEntry:
     """
-    Создает, авторизует и возвращает клиент Telethon.
-    Использует кэш для уже подключенных клиентов, чтобы избежать лишних соединений.
+    Запись пула: подключенный клиент, время последнего обращения и кэш
+    профиля аккаунта (результат get_me) с состоянием последней проверки.
+    """
+    __slots__ = ("client", "session_string", "last_used", "profile", "status", "checked_at")
+
+    def __init__(self, client: TelegramClient, session_string: Optional[str], profile):
+        self.client = client
+        self.session_string = session_string
+        self.last_used = time.monotonic()
+        self.profile = profile  # None - клиент не авторизован
+        self.status = "ok" if profile is not None else "unauthorized"
+        self.checked_at = time.time()
+
+    @property
+    def authorized(self) -> bool:
+        return self.profile is not None
+
+
+class ClientPool:
+    """
+    Пул подключенных клиентов UserBot {user_id: client}.
+    - для одного user_id одновременно выполняется не более одного подключения;
+    - живых соединений не больше max_clients, лишние вытесняются по LRU;
+    - клиенты, простаивающие дольше idle_timeout, отключаются;
+    - вытесненные и удаленные клиенты всегда отключаются (disconnect).
+    """
+
+    def __init__(self, max_clients: int = POOL_MAX_CLIENTS, idle_timeout: float = POOL_IDLE_TIMEOUT):
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self._entries: "OrderedDict[int, _PoolEntry]" = OrderedDict()  # от давно использованных к свежим
+        self._connecting: dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # запросы, дождавшиеся уже идущего подключения
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """Счетчики пула для логов и отладки."""
+        return {
+            "size": len(self._entries),
+            "connecting": len(self._connecting),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+    async def get(self, user_id: int, session_string: Optional[str],
+                  connect: Callable[[], Awaitable[tuple[TelegramClient, object]]]) -> TelegramClient:
+        """
+        Возвращает клиент из пула или подключает новый через connect().
+        connect должен вернуть кортеж (подключенный клиент, профиль get_me или None,
+        если клиент не авторизован).
+        """
+        await self.sweep()
+
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            if entry.session_string == session_string and entry.client.is_connected():
+                self.hits += 1
+                entry.last_used = time.monotonic()
+                self._entries.move_to_end(user_id)
+                return entry.client
+            # Сессия сменилась (повторный /login) или соединение разорвано
+            await self.discard(user_id)
+
+        task = self._connecting.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._connect(user_id, session_string, connect))
+            self._connecting[user_id] = task
+            task.add_done_callback(lambda _: self._connecting.pop(user_id, None))
+        else:
+            self.coalesced += 1
+        # shield: отмена одного обработчика не должна прерывать подключение для остальных
+        return await asyncio.shield(task)
+
+    async def _connect(self, user_id: int, session_string: Optional[str],
+                       connect: Callable[[], Awaitable[tuple[TelegramClient, object]]]) -> TelegramClient:
+        client, profile = await connect()
+        self._entries[user_id] = _PoolEntry(client, session_string, profile)
+        await self._evict_overflow()
+        return client
+
+    def cached_status(self, user_id: int) -> Optional[tuple]:
+        """
+        Кэш без обращения к Telegram: (профиль, состояние, time.time() проверки)
+        или None, если клиента пользователя в пуле нет.
+        """
+        entry = self._entries.get(user_id)
+        return (entry.profile, entry.status, entry.checked_at) if entry is not None else None
+
+    def set_status(self, user_id: int, status: str, profile=None):
+        """Обновить состояние клиента (и профиль, если он получен) после проверки."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return
+        entry.status = status
+        entry.checked_at = time.time()
+        if profile is not None:
+            entry.profile = profile
+
+    def live_clients(self) -> list[tuple[int, TelegramClient]]:
+        """Снимок авторизованных клиентов пула: [(user_id, client)]."""
+        return [(user_id, entry.client) for user_id, entry in self._entries.items() if entry.authorized]
+
+    async def adopt(self, user_id: int, session_string: Optional[str], client: TelegramClient, profile):
+        """
+        Положить в пул уже подключенный и авторизованный клиент
+        (например, оставшийся после входа) с его профилем, чтобы не
+        подключаться повторно.
+        """
+        await self.discard(user_id)
+        scheduler.bind(client, user_id)
+        self._entries[user_id] = _PoolEntry(client, session_string, profile)
+        await self._evict_overflow()
+
+    async def _evict_overflow(self):
+        """Вытесняет давно использованных клиентов сверх max_clients."""
+        overflow = []
+        while len(self._entries) > self.max_clients:
+            _, old = self._entries.popitem(last=False)
+            overflow.append(old.client)
+        await self._disconnect_all(overflow)
+
+    async def discard(self, user_id: int):
+        """Удаляет клиента пользователя из пула и отключает его."""
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            await self._disconnect_all([entry.client])
+
+    async def sweep(self):
+        """Отключает клиентов, простаивающих дольше idle_timeout."""
+        deadline = time.monotonic() - self.idle_timeout
+        idle = []
+        # Записи упорядочены по last_used, поэтому достаточно пройти с начала
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if entry.last_used > deadline:
+                break
+            del self._entries[user_id]
+            idle.append(entry.client)
+        await self._disconnect_all(idle)
+
+    async def run_sweeper(self, interval: float = POOL_SWEEP_INTERVAL):
+        """Фоновая задача периодической очистки простаивающих клиентов."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.sweep()
+
+    async def close(self):
+        """Отключает всех клиентов пула (вызывается при остановке бота)."""
+        tasks = list(self._connecting.values())
+        for task in tasks:
+            task.cancel()
+        # Отмененные подключения сами отключают своих клиентов (см. _connect_client)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        clients = [entry.client for entry in self._entries.values()]
+        self._entries.clear()
+        await self._disconnect_all(clients)
+        logging.info(f"Пул клиентов UserBot закрыт: {self.stats()}")
+
+    async def _disconnect_all(self, clients: list):
+        if not clients:
+            return
+        self.evictions += len(clients)
+        results = await asyncio.gather(*(c.disconnect() for c in clients), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.warning(f"Ошибка при отключении клиента UserBot: {result}")
+
+
+# Глобальный пул активных клиентов UserBot
+userbot_pool = ClientPool()
+metrics.register_gauge("userbot_pool_clients", "Подключенные клиенты в пуле", lambda: len(userbot_pool))
+metrics.register_gauge("userbot_pool_hits", "Попадания в пул", lambda: userbot_pool.hits)
+metrics.register_gauge("userbot_pool_misses", "Промахи пула (новые подключения)", lambda: userbot_pool.misses)
+metrics.register_gauge("userbot_pool_evictions", "Отключенные пулом клиенты", lambda: userbot_pool.evictions)
+
+
+PENDING_LOGIN_TTL = int(os.getenv("USERBOT_PENDING_LOGIN_TTL", "600"))  # секунд между шагами входа
+
+
+class PendingLogin:
+    """Незавершенный вход: подключенный клиент и данные шагов."""
+    __slots__ = ("client", "data", "expires_at")
+
+    def __init__(self, client: TelegramClient, data: dict, ttl: float):
+        self.client = client
+        self.data = data
+        self.expires_at = time.monotonic() + ttl
+
+
+class PendingLogins:
+    """
+    Кэш клиентов незавершенных входов {ключ: PendingLogin}.
+    Клиент остается подключенным между шагами (телефон -> код -> пароль),
+    поэтому весь вход обходится одним подключением. Запись отключается
+    по таймауту простоя ttl, при сбросе (drop) или забирается при успехе (pop).
     """
-    if user_id in userbot_clients and userbot_clients[user_id].is_connected():
-        return userbot_clients[user_id]
 
-    # StringSession хранит сессию в виде строки, что идеально для сохранения в БД
-    session = StringSession(session_string)
+    def __init__(self, ttl: float = PENDING_LOGIN_TTL):
+        self.ttl = ttl
+        self._entries: dict = {}
+
+    async def put(self, key, client: TelegramClient, **data):
+        """Запомнить подключенный клиент входа; прежний вход с тем же ключом отключается."""
+        await self.drop(key)
+        self._entries[key] = PendingLogin(client, data, self.ttl)
+
+    def get(self, key) -> Optional[PendingLogin]:
+        """Незавершенный вход по ключу; каждое обращение продлевает его срок."""
+        entry = self._entries.get(key)
+        if entry is None or entry.expires_at <= time.monotonic():
+            return None
+        entry.expires_at = time.monotonic() + self.ttl
+        return entry
+
+    def pop(self, key) -> Optional[PendingLogin]:
+        """Забрать вход без отключения клиента (например, чтобы передать его в пул)."""
+        return self._entries.pop(key, None)
+
+    async def drop(self, key):
+        """Забыть вход и отключить его клиент."""
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.client.is_connected():
+            await entry.client.disconnect()
+
+    async def sweep(self):
+        """Отключить входы, брошенные дольше ttl."""
+        now = time.monotonic()
+        for key in [k for k, entry in self._entries.items() if entry.expires_at <= now]:
+            await self.drop(key)
+
+    async def run_sweeper(self, interval: float = POOL_SWEEP_INTERVAL):
+        """Фоновая задача периодической очистки брошенных входов."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.sweep()
+
+    async def close(self):
+        for key in list(self._entries):
+            await self.drop(key)
+
+
+# Клиенты незавершенных входов (бот: ключ - user_id, веб-интерфейс - токен формы)
+pending_logins = PendingLogins()
+
+async def _connect_client(user_id: int, api_id: int, api_hash: str,
+                          session_string: Optional[str]) -> tuple[TelegramClient, object]:
+    """Создает и подключает клиент Telethon. Возвращает (клиент, профиль или None без авторизации)."""
+    # Сессия с кэшем сущностей в общей базе; без нее (например, в web.py) - StringSession в памяти
+    if tg_session.db is not None:
+        session = await tg_session.load(user_id, session_string)
+    else:
+        session = StringSession(session_string)
     
     # Указываем параметры устройства, чтобы сессия выглядела как с мобильного приложения
     client = TelegramClient(session, api_id, api_hash,
@@ -33,69 +298,234 @@ async def get_userbot_client(user_id: int, api_id: int, api_hash: str, session_s
                             app_version="9.6.3",
                             lang_code="en")
     
+    scheduler.bind(client, user_id)
     logging.info(f"Подключение UserBot для пользователя {user_id}...")
-    await client.connect()
+    try:
+        await metrics.timed("connect", client.connect)()
 
-    if not await client.is_user_authorized():
-        logging.warning(f"UserBot для {user_id} не авторизован. Требуется вход.")
-        # Этот клиент будет использоваться для процесса входа
-        return client
+        if not await metrics.timed("is_user_authorized", client.is_user_authorized)():
+            logging.warning(f"UserBot для {user_id} не авторизован. Требуется вход.")
+            return client, None
 
-    me = await client.get_me()
+        # Профиль запрашивается один раз и дальше отдается из кэша пула
+        me = await metrics.timed("get_me", client.get_me)()
+    except BaseException:
+        # Ошибка или отмена (остановка пула): подключенный клиент никому не достанется
+        await client.disconnect()
+        raise
     logging.info(f"UserBot успешно авторизован как: {me.first_name} (@{me.username})")
-    userbot_clients[user_id] = client
-    return client
+    return client, me
+
+async def get_userbot_client(user_id: int, api_id: int, api_hash: str, session_string: Optional[str] = None) -> TelegramClient:
+    """
+    Создает, авторизует и возвращает клиент Telethon.
+    Клиенты берутся из пула userbot_pool, чтобы избежать лишних соединений.
+    Неавторизованные клиенты тоже учитываются пулом и отключаются при вытеснении.
+    """
+    return await userbot_pool.get(
+        user_id, session_string,
+        lambda: _connect_client(user_id, api_id, api_hash, session_string)
+    )
+
+# Прогрев пула при запуске бота
+WARMUP_ENABLED = os.getenv("USERBOT_WARMUP", "0") == "1"
+WARMUP_CONCURRENCY = int(os.getenv("USERBOT_WARMUP_CONCURRENCY", "10"))
+
+# Фоновая проверка подключенных клиентов
+HEALTH_CHECK_INTERVAL = int(os.getenv("USERBOT_HEALTH_INTERVAL", "600"))  # секунд, 0 - не проверять
+HEALTH_CHECK_CONCURRENCY = int(os.getenv("USERBOT_HEALTH_CONCURRENCY", "10"))
+
+def session_status_for_error(e: Exception) -> str:
+    """Состояние сессии (db.SESSION_STATUSES) по ошибке Telethon."""
+    if isinstance(e, (errors.UserDeactivatedBanError, errors.UserDeactivatedError, errors.PhoneNumberBannedError)):
+        return "banned"
+    if isinstance(e, (errors.UnauthorizedError, errors.AuthKeyDuplicatedError)):
+        return "unauthorized"  # ключ отозван или истек - нужен повторный /login
+    if isinstance(e, (errors.FloodWaitError, scheduler.CooldownError)):
+        return "flood"
+    return "error"
+
+async def warm_up_pool(db, concurrency: int = WARMUP_CONCURRENCY,
+                       shard: tuple = None) -> list[tuple[int, str, float]]:
+    """
+    Подключить сохраненные сессии (в режиме шардов - только сессии шарда shard)
+    заранее, не более concurrency одновременно, чтобы первая команда
+    пользователя не ждала connect и get_me.
+    Результат каждой сессии записывается в sessions.status, неавторизованные
+    клиенты в пуле не остаются. Возвращает отчет [(user_id, статус, секунд до готовности)].
+    """
+    sessions = await db.get_sessions_for_warmup(userbot_pool.max_clients, shard)
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+    logging.info(f"Прогрев пула: {len(sessions)} сессий, параллельно до {concurrency}")
+
+    async def warm_up_one(user_id: int, api_id: int, api_hash: str, session_string: str):
+        async with semaphore:
+            try:
+                await get_userbot_client(user_id, api_id, api_hash, session_string)
+                _, status, _ = userbot_pool.cached_status(user_id)
+                if status != "ok":
+                    await userbot_pool.discard(user_id)
+            except Exception as e:
+                status = session_status_for_error(e)
+                logging.warning(f"Прогрев: не удалось подключить {user_id} ({status}): {e}")
+        ready_in = time.monotonic() - started
+        await db.set_session_status(user_id, status)
+        await db.log_event("WARMUP", f"Сессия {user_id}: {status} за {ready_in:.2f} с",
+                           user_id=user_id, outcome="ok" if status == "ok" else "fail")
+        return user_id, status, ready_in
+
+    report = await asyncio.gather(*(warm_up_one(*row) for row in sessions))
+    counts = {}
+    for _, status, _ in report:
+        counts[status] = counts.get(status, 0) + 1
+    ready = sorted(ready_in for _, status, ready_in in report if status == "ok")
+    logging.info(
+        f"Прогрев пула завершен за {time.monotonic() - started:.1f} с: {counts}"
+        + (f", готовность p50 {ready[len(ready) // 2]:.2f} с, max {ready[-1]:.2f} с" if ready else "")
+    )
+    return report
+
+async def _probe_client(client: TelegramClient) -> tuple[str, object]:
+    """Проверить один клиент через get_me: (состояние, свежий профиль или None)."""
+    account = scheduler.for_client(client)
+    if await account.remaining() > 0:
+        return "flood", None  # аккаунт и так ждет FloodWait - не тревожим Telegram
+    try:
+        me = await metrics.timed("get_me", client.get_me)()
+    except errors.FloodWaitError as e:
+        await account.pause(e.seconds + scheduler.FLOOD_WAIT_MARGIN)
+        return "flood", None
+    except Exception as e:
+        return session_status_for_error(e), None
+    # get_me возвращает None, если сессия больше не авторизована
+    return ("ok", me) if me is not None else ("unauthorized", None)
+
+async def check_pool_health(db, concurrency: int = HEALTH_CHECK_CONCURRENCY) -> dict:
+    """
+    Проверить все авторизованные клиенты пула, не более concurrency одновременно.
+    Обновляет кэш профилей и sessions.status; неавторизованные и заблокированные
+    клиенты удаляются из пула. Возвращает число клиентов по состояниям.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(user_id: int, client: TelegramClient):
+        async with semaphore:
+            return (user_id, *await _probe_client(client))
+
+    results = await asyncio.gather(*(probe(*item) for item in userbot_pool.live_clients()))
+    counts = {}
+    for user_id, status, profile in results:
+        counts[status] = counts.get(status, 0) + 1
+        userbot_pool.set_status(user_id, status, profile)
+        if status in ("unauthorized", "banned"):
+            logging.warning(f"Проверка: сессия {user_id} - {status}, клиент отключен")
+            await userbot_pool.discard(user_id)
+    await db.set_session_statuses([(user_id, status) for user_id, status, _ in results])
+    return counts
+
+async def run_health_checker(db, interval: float = HEALTH_CHECK_INTERVAL):
+    """Фоновая задача периодической проверки клиентов пула."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            counts = await check_pool_health(db)
+        except Exception:
+            logging.exception("Ошибка фоновой проверки клиентов UserBot")
+            continue
+        if counts:
+            logging.info(f"Проверка клиентов UserBot: {counts}")
+
+async def _rpc(client: TelegramClient, request):
+    """Вызов запроса MTProto с замером времени по имени запроса."""
+    return await metrics.timed(type(request).__name__, client)(request)
 
 async def join_chat(client: TelegramClient, chat_link: str) -> tuple[bool, str]:
     """
-    Вступление в чат по публичной ссылке или приватной ссылке-приглашению.
+    Вступление в чат по публичной ссылке, @username или приватной ссылке-приглашению.
+    Если по кэшу участия (membership.cache) аккаунт уже состоит в чате, ответ
+    возвращается без запросов к Telegram и без ожидания лимита вступлений;
+    одновременные вступления по одной ссылке выполняются один раз.
     Возвращает кортеж (успех, сообщение).
     """
     try:
-        await asyncio.sleep(5)
+        link = membership.parse_link(chat_link)
+    except ValueError as e:
+        msg = f"❌ Неверная ссылка на чат: {chat_link}. Ошибка: {e}"
+        logging.error(msg)
+        return False, msg
 
-        # Для публичных чатов — проверяем участие через GetParticipantRequest
-        if 't.me/' in chat_link and not ('t.me/+' in chat_link or 't.me/joinchat/' in chat_link):
-            username = chat_link.split('/')[-1]
-            try:
-                entity = await client.get_entity(username)
-                try:
-                    await client(GetParticipantRequest(entity, 'me'))
-                    return True, f"ℹ️ Уже являюсь участником чата: {chat_link}"
-                except UserNotParticipantError:
-                    pass  # Не участник — можно вступать
-            except Exception as e:
-                logging.warning(f"[join_chat] Не удалось получить entity для публичного чата {chat_link}: {e}")
-                pass
+    account_id = scheduler.for_client(client).account_id
+    cache = membership.cache if account_id is not None else None
+    if cache is None:
+        return await _join_chat(client, link, chat_link, None)
+    if await cache.member_chat(account_id, link) is not None:
+        return True, f"ℹ️ Уже являюсь участником чата: {chat_link}"
+    return await cache.single_flight(account_id, link, lambda: _join_chat(client, link, chat_link, cache))
+
+async def _join_chat(client: TelegramClient, link: membership.ChatLink, chat_link: str,
+                     cache: Optional[membership.MembershipCache]) -> tuple[bool, str]:
+    """
+    Проверка участия и вступление через Telegram. Проверка не расходует лимит
+    вступлений; темп вступлений и паузы после FloodWait задает планировщик аккаунта.
+    """
+    account = scheduler.for_client(client)
+
+    async def _check():
+        """(entity или None, chat_id или None, уже участник)."""
+        if link.kind == "invite":
+            invite = await _rpc(client, CheckChatInviteRequest(link.value))
+            if isinstance(invite, ChatInviteAlready):
+                return None, invite.chat.id, True
+            return None, None, False
+        entity = await metrics.timed("get_entity", client.get_entity)(link.value)
+        try:
+            await _rpc(client, GetParticipantRequest(entity, 'me'))
+            return entity, entity.id, True
+        except UserNotParticipantError:
+            pass  # Не участник — можно вступать
+        except errors.FloodWaitError:
+            raise
+        except Exception as e:
+            # Например, обычная группа или пользователь: проверка участия недоступна
+            logging.warning(f"[join_chat] Не удалось проверить участие в {chat_link}: {e}")
+        return entity, entity.id, False
 
-        # Для приватных чатов — старая логика, с подробным логированием
-        if 't.me/+' in chat_link or 't.me/joinchat/' in chat_link:
-            hash_code = chat_link.split('/')[-1]
-            logging.info(f"[join_chat] Приватная ссылка: {chat_link}, hash_code: {hash_code}")
+    async def _join(entity) -> Optional[int]:
+        if link.kind == "invite":
+            logging.info(f"[join_chat] Приватная ссылка: {chat_link}, hash_code: {link.value}")
             try:
-                result = await client(ImportChatInviteRequest(hash_code))
+                result = await _rpc(client, ImportChatInviteRequest(link.value))
                 logging.info(f"[join_chat] Результат ImportChatInviteRequest: {result}")
             except Exception as e:
-                logging.error(f"[join_chat] Ошибка ImportChatInviteRequest для {chat_link} (hash: {hash_code}): {e}")
+                logging.error(f"[join_chat] Ошибка ImportChatInviteRequest для {chat_link} (hash: {link.value}): {e}")
                 raise
-        else:
-            entity = await client.get_entity(chat_link)
-            await client(JoinChannelRequest(entity))
+            chats = getattr(result, "chats", None)
+            return chats[0].id if chats else None
+        await _rpc(client, JoinChannelRequest(entity))
+        return entity.id
 
-        msg = f"✅ Успешно вступил в чат: {chat_link}"
+    try:
+        entity, chat_id, already = await account.run("join_check", _check)
+        if already:
+            msg = f"ℹ️ Уже являюсь участником чата: {chat_link}"
+        else:
+            chat_id = await account.run("join", _join, entity)
+            msg = f"✅ Успешно вступил в чат: {chat_link}"
+        if cache is not None and chat_id is not None:
+            await cache.remember(account.account_id, chat_id, link)
         logging.info(msg)
         return True, msg
 
-    except errors.FloodWaitError as e:
-        msg = f"⏳ Превышен лимит запросов. Жду {e.seconds} секунд и пробую снова."
+    except (errors.FloodWaitError, scheduler.CooldownError) as e:
+        msg = f"⏳ Превышен лимит запросов ({e.seconds} с). Аккаунт приостановлен, попробуйте позже: {chat_link}"
         logging.warning(msg)
-        await asyncio.sleep(e.seconds + 5)
-        return await join_chat(client, chat_link)
+        return False, msg
     except errors.UserAlreadyParticipantError:
         msg = f"ℹ️ Уже являюсь участником чата: {chat_link}"
         logging.info(msg)
         return True, msg
-    except (ValueError, TypeError, errors.InviteHashInvalidError) as e:
+    except (ValueError, TypeError, errors.InviteHashInvalidError, errors.InviteHashExpiredError) as e:
         msg = f"❌ Неверная или истекшая ссылка-приглашение: {chat_link}. Ошибка: {e}"
         logging.error(msg)
         return False, msg
@@ -106,25 +536,54 @@ async def join_chat(client: TelegramClient, chat_link: str) -> tuple[bool, str]:
         logging.error(msg)
         return False, msg
 
-async def send_message(client: TelegramClient, chat_entity, message: str) -> tuple[bool, str]:
+async def _send_file(client: TelegramClient, chat_entity, caption: str, attachment: uploads.Attachment):
+    """
+    Отправка вложения. Файл, который этот аккаунт уже загружал, отправляется по
+    сохраненной ссылке (uploads.cache) без повторной загрузки; если ссылка устарела
+    (FileReferenceExpiredError и другие FILE_REFERENCE_*), файл загружается заново.
+    """
+    account_id = scheduler.for_client(client).account_id
+    cache = uploads.cache if account_id is not None else None
+    send_file = metrics.timed("send_file", client.send_file)
+    force_document = attachment.kind == "document"
+    digest = await uploads.content_hash(attachment.data) if cache is not None else None
+    if cache is not None:
+        media = await cache.get(account_id, digest, attachment.kind)
+        if media is not None:
+            try:
+                return await send_file(chat_entity, media, caption=caption, force_document=force_document)
+            except errors.BadRequestError as e:
+                if not e.message.startswith("FILE_REFERENCE_"):
+                    raise
+                logging.info(f"Ссылка на файл {attachment.name} устарела ({e.message}), загружаю заново")
+                await cache.forget(account_id, digest, attachment.kind)
+    sent = await send_file(chat_entity, attachment.as_file(), caption=caption, force_document=force_document)
+    if cache is not None:
+        await cache.put(account_id, digest, attachment.kind, sent.media)
+    return sent
+
+async def send_message(client: TelegramClient, chat_entity, message: str,
+                       attachment: Optional[uploads.Attachment] = None) -> tuple[bool, str]:
     """
-    Отправка сообщения в указанный чат.
+    Отправка сообщения в указанный чат; с attachment - фото или документ
+    с подписью message. Темп отправки и паузы после FloodWait задает планировщик аккаунта.
     Возвращает кортеж (успех, сообщение).
     """
     try:
-        # Адаптивная задержка
-        await asyncio.sleep(3)
-        
-        await client.send_message(chat_entity, message)
+        account = scheduler.for_client(client)
+        if attachment is None:
+            await account.run("send", metrics.timed("send_message", client.send_message),
+                              chat_entity, message, chat=chat_entity)
+        else:
+            await account.run("send", _send_file, client, chat_entity, message, attachment, chat=chat_entity)
         msg = f"✅ Сообщение успешно отправлено в чат {chat_entity}"
         logging.info(msg)
         return True, msg
         
-    except errors.FloodWaitError as e:
-        msg = f"⏳ Превышен лимит запросов при отправке. Жду {e.seconds} секунд."
+    except (errors.FloodWaitError, errors.SlowModeWaitError, scheduler.CooldownError) as e:
+        msg = f"⏳ Превышен лимит запросов при отправке ({e.seconds} с). Попробуйте позже."
         logging.warning(msg)
-        await asyncio.sleep(e.seconds + 5)
-        return await send_message(client, chat_entity, message) # Повтор
+        return False, msg
     except Exception as e:
         msg = f"❌ Ошибка при отправке сообщения в {chat_entity}: {e}"
         logging.error(msg)
@@ -1,61 +1,247 @@
-from flask import Flask, request, redirect, render_template_string
-from telethon.sync import TelegramClient
-from telethon.sessions import StringSession
+import asyncio
+import html
+import logging
 import os
+import secrets
+
+from aiohttp import web
+from telethon import TelegramClient, errors
+from telethon.sessions import StringSession
+
+from db import Database, AsyncDatabase
+import log_export
+import utils
 
-app = Flask(__name__)
+# Интерфейс без авторизации: по умолчанию доступен только с этой машины
+WEB_HOST = os.getenv("USERBOT_WEB_HOST", "127.0.0.1")
+WEB_PORT = int(os.getenv("USERBOT_WEB_PORT", "8080"))
+# Токен выгрузки логов; без него /export_logs доступна только с локального адреса
+WEB_EXPORT_TOKEN = os.getenv("USERBOT_WEB_EXPORT_TOKEN", "")
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+ACCOUNTS_PAGE_SIZE = 20
 
-ACCOUNTS_DIR = "sessions"
-os.makedirs(ACCOUNTS_DIR, exist_ok=True)
+# Та же база, что у бота: аккаунты хранятся в таблице sessions
+db = AsyncDatabase(Database())
 
-# HTML шаблон
-html = '''
+# HTML шаблоны
+PAGE = '''<!doctype html>
+<meta charset="utf-8">
+<title>UserBot Manager</title>
+{body}
+'''
+
+ADD_FORM = '''
 <h2>Добавить Telegram аккаунт</h2>
+{error}
 <form action="/add_account" method="post">
   API ID: <input name="api_id"><br>
   API HASH: <input name="api_hash"><br>
   Номер телефона: <input name="phone"><br>
-  <input type="submit" value="Авторизовать">
+  ID пользователя в боте (необязательно): <input name="owner_id"><br>
+  <input type="submit" value="Отправить код">
+</form>
+'''
+
+CODE_FORM = '''
+<h2>Подтверждение входа</h2>
+{error}
+<form action="/confirm_code" method="post">
+  <input type="hidden" name="token" value="{token}">
+  Код из Telegram: <input name="code"><br>
+  <input type="submit" value="Войти">
+</form>
+'''
+
+PASSWORD_FORM = '''
+<h2>Двухфакторная аутентификация</h2>
+{error}
+<form action="/confirm_password" method="post">
+  <input type="hidden" name="token" value="{token}">
+  Облачный пароль: <input name="password" type="password"><br>
+  <input type="submit" value="Войти">
+</form>
+'''
+
+EXPORT_FORM = '''
+<h2>Выгрузка логов</h2>
+<form action="/export_logs" method="get">
+  С (YYYY-MM-DD): <input name="from"> по: <input name="to"><br>
+  Тип события: <input name="event_type"> ID пользователя: <input name="user_id" required><br>
+  Токен (если задан USERBOT_WEB_EXPORT_TOKEN): <input name="token" type="password"><br>
+  <select name="format"><option>csv</option><option>jsonl</option></select>
+  <input type="submit" value="Скачать .gz">
 </form>
+'''
 
-<h2>Доступные аккаунты</h2>
-<ul>
-  {% for s in sessions %}
-    <li>{{ s }} <a href="/remove_account/{{s}}">Удалить</a></li>
-  {% endfor %}
-</ul>
+ACCOUNT_ROW = '''
+  <li>{user_id} (api_id {api_id})
+    <form action="/remove_account/{user_id}" method="post" style="display:inline">
+      <input type="submit" value="Удалить">
+    </form>
+  </li>
 '''
 
-@app.route("/")
-def index():
-    sessions = [f for f in os.listdir(ACCOUNTS_DIR) if f.endswith(".session")]
-    return render_template_string(html, sessions=sessions)
-
-@app.route("/add_account", methods=["POST"])
-def add_account():
-    api_id = int(request.form["api_id"])
-    api_hash = request.form["api_hash"]
-    phone = request.form["phone"]
-    
-    session_path = os.path.join(ACCOUNTS_DIR, f"{phone}.session")
-
-    async def auth():
-        client = TelegramClient(session_path, api_id, api_hash)
-        await client.start(phone=lambda: phone)
+
+def render(*parts: str) -> web.Response:
+    return web.Response(text=PAGE.format(body="".join(parts)), content_type="text/html")
+
+def error_block(message: str) -> str:
+    return f'<p style="color:red">{html.escape(message)}</p>' if message else ""
+
+async def accounts_page(request: web.Request) -> str:
+    after = request.query.get("after")
+    rows = await db.get_sessions_page(int(after) if after else None, ACCOUNTS_PAGE_SIZE)
+    items = "".join(ACCOUNT_ROW.format(user_id=user_id, api_id=api_id) for user_id, api_id in rows)
+    more = ""
+    if len(rows) == ACCOUNTS_PAGE_SIZE:
+        more = f'<a href="/?after={rows[-1][0]}">Дальше ▶</a>'
+    return f"<h2>Доступные аккаунты</h2>\n<ul>{items}</ul>\n{more}"
+
+async def finish_login(token: str) -> web.Response:
+    """
+    Сохранить сессию в БД и отключить клиент: клиенты UserBot держит процесс бота,
+    он подключит аккаунт по сохраненной сессии при первой задаче.
+    """
+    # Незавершенные входы общие с ботом (utils.pending_logins), ключ - токен формы
+    login = utils.pending_logins.pop(token)
+    client, data = login.client, login.data
+    try:
+        me = await client.get_me()
+        user_id = data["owner_id"] or me.id
+        session_string = client.session.save()
+        await db.save_session(user_id, data["api_id"], data["api_hash"], session_string)
+        await db.log_event("AUTH_SUCCESS_WEB", f"Аккаунт {me.id} авторизован через веб-интерфейс.",
+                           user_id=user_id, outcome="ok")
         await client.send_message("me", "✅ Успешная авторизация!")
+    except Exception as e:
+        return render(ADD_FORM.format(error=error_block(f"Не удалось сохранить сессию: {e}")))
+    finally:
         await client.disconnect()
+    raise web.HTTPFound("/")
+
+async def index(request: web.Request):
+    return render(ADD_FORM.format(error=""), await accounts_page(request), EXPORT_FORM)
+
+def export_allowed(request: web.Request) -> bool:
+    """Выгрузка по токену, если он задан, иначе только с локального адреса."""
+    if WEB_EXPORT_TOKEN:
+        return secrets.compare_digest(request.query.get("token", "").encode(), WEB_EXPORT_TOKEN.encode())
+    return request.remote in LOCAL_ADDRESSES
+
+async def export_logs(request: web.Request):
+    """Потоковая выгрузка логов одного пользователя в gzip: строки читаются и отправляются пачками."""
+    if not export_allowed(request):
+        raise web.HTTPForbidden(text="Выгрузка логов доступна только локально или по USERBOT_WEB_EXPORT_TOKEN")
+    query = request.query
+    try:
+        fmt = query.get("format", "csv")
+        if fmt not in log_export.EXPORT_FORMATS:
+            raise ValueError(fmt)
+        since = log_export.parse_day(query["from"]) if query.get("from") else None
+        until = log_export.parse_day(query["to"]) + 86400 if query.get("to") else None
+        user_id = int(query.get("user_id", ""))
+    except ValueError:
+        raise web.HTTPBadRequest(
+            text="Неверные параметры: user_id обязателен, from/to - YYYY-MM-DD, format - csv или jsonl")
+    response = web.StreamResponse(headers={
+        "Content-Type": "application/gzip",
+        "Content-Disposition": f'attachment; filename="{log_export.export_filename(fmt)}"',
+    })
+    await response.prepare(request)
+    async for chunk in log_export.stream_logs(db, fmt, user_id=user_id, event_type=query.get("event_type") or None,
+                                              since=since, until=until):
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+async def add_account(request: web.Request):
+    form = await request.post()
+    try:
+        api_id = int(form["api_id"])
+        api_hash = form["api_hash"].strip()
+        phone = form["phone"].strip()
+        owner_id = int(form["owner_id"]) if form.get("owner_id", "").strip() else None
+    except (KeyError, ValueError):
+        return render(ADD_FORM.format(error=error_block("Проверьте API ID, API HASH и номер телефона.")))
+
+    client = TelegramClient(StringSession(), api_id, api_hash)
+    try:
+        await client.connect()
+        sent_code = await client.send_code_request(phone)
+    except Exception as e:
+        await client.disconnect()
+        return render(ADD_FORM.format(error=error_block(f"Не удалось отправить код: {e}")))
+
+    # Клиент остается подключенным до ввода кода и пароля
+    token = secrets.token_urlsafe(16)
+    await utils.pending_logins.put(token, client, api_id=api_id, api_hash=api_hash, phone=phone,
+                                   owner_id=owner_id, phone_code_hash=sent_code.phone_code_hash)
+    return render(CODE_FORM.format(token=token, error=""))
+
+async def confirm_code(request: web.Request):
+    form = await request.post()
+    token = form.get("token", "")
+    login = utils.pending_logins.get(token)
+    if login is None:
+        return render(ADD_FORM.format(error=error_block("Время входа истекло, начните заново.")))
+    try:
+        await login.client.sign_in(phone=login.data["phone"], code=form.get("code", "").strip(),
+                                   phone_code_hash=login.data["phone_code_hash"])
+    except errors.SessionPasswordNeededError:
+        return render(PASSWORD_FORM.format(token=token, error=""))
+    except errors.PhoneCodeInvalidError:
+        return render(CODE_FORM.format(token=token, error=error_block("Неверный код.")))
+    except Exception as e:
+        await utils.pending_logins.drop(token)
+        return render(ADD_FORM.format(error=error_block(f"Ошибка входа: {e}")))
+    return await finish_login(token)
+
+async def confirm_password(request: web.Request):
+    form = await request.post()
+    token = form.get("token", "")
+    login = utils.pending_logins.get(token)
+    if login is None:
+        return render(ADD_FORM.format(error=error_block("Время входа истекло, начните заново.")))
+    try:
+        await login.client.sign_in(password=form.get("password", ""))
+    except errors.PasswordHashInvalidError:
+        return render(PASSWORD_FORM.format(token=token, error=error_block("Неверный пароль.")))
+    except Exception as e:
+        await utils.pending_logins.drop(token)
+        return render(ADD_FORM.format(error=error_block(f"Ошибка входа: {e}")))
+    return await finish_login(token)
+
+async def remove_account(request: web.Request):
+    user_id = int(request.match_info["user_id"])
+    # Клиенты UserBot держит процесс бота; если он отключит клиент уже после удаления,
+    # записанные им сущности без строки сессии удалит Database.load_tg_session
+    await db.delete_session(user_id)
+    raise web.HTTPFound("/")
 
-    import asyncio
-    asyncio.run(auth())
+async def on_startup(app: web.Application):
+    # Брошенные входы отключаются по таймауту, даже если страницу никто не открывает
+    app["login_sweeper"] = asyncio.create_task(utils.pending_logins.run_sweeper())
 
-    return redirect("/")
+async def on_cleanup(app: web.Application):
+    app["login_sweeper"].cancel()
+    await asyncio.gather(app["login_sweeper"], return_exceptions=True)
+    await utils.pending_logins.close()
+    await db.close()
 
-@app.route("/remove_account/<filename>")
-def remove_account(filename):
-    path = os.path.join(ACCOUNTS_DIR, filename)
-    if os.path.exists(path):
-        os.remove(path)
-    return redirect("/")
+def create_app() -> web.Application:
+    app = web.Application()
+    app.add_routes([
+        web.get("/", index),
+        web.get("/export_logs", export_logs),
+        web.post("/add_account", add_account),
+        web.post("/confirm_code", confirm_code),
+        web.post("/confirm_password", confirm_password),
+        web.post(r"/remove_account/{user_id:-?\d+}", remove_account),
+    ])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
 
 if __name__ == "__main__":
-    app.run(debug=True, port=8080)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    web.run_app(create_app(), host=WEB_HOST, port=WEB_PORT)
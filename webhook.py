@@ -0,0 +1,115 @@
+# webhook.py
+import asyncio
+import logging
+import os
+import secrets
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("USERBOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("USERBOT_WEBHOOK_URL", "")  # публичный https-адрес; пусто - set_webhook не вызывается
+WEBHOOK_PATH = os.getenv("USERBOT_WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("USERBOT_WEBHOOK_HOST", "127.0.0.1")  # снаружи - через reverse proxy
+WEBHOOK_PORT = int(os.getenv("USERBOT_WEBHOOK_PORT", "8081"))
+WEBHOOK_SECRET = os.getenv("USERBOT_WEBHOOK_SECRET", "")  # обязателен в режиме webhook
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("USERBOT_WEBHOOK_MAX_IN_FLIGHT", "100"))
+WEBHOOK_DRAIN_TIMEOUT = 30  # секунд на завершение начатых апдейтов при остановке
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Прием апдейтов aiogram через webhook на aiohttp.
+    - запрос без верного секрета (заголовок X-Telegram-Bot-Api-Secret-Token) - 401;
+      без секрета сервер не запускается: иначе любой, кто достучится до порта,
+      сможет прислать поддельный апдейт от имени любого пользователя;
+    - одновременно обрабатывается не больше max_in_flight апдейтов: следующий
+      запрос ждет свободного места, и Telegram сам снижает темп отправки;
+    - апдейт подтверждается (200) сразу после постановки в обработку;
+    - при остановке новые запросы получают 503 (Telegram повторит их позже),
+      а начатые апдейты дорабатывают до drain_timeout секунд.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str = WEBHOOK_SECRET,
+                 max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT, drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        if not secret:
+            raise ValueError("Режим webhook требует USERBOT_WEBHOOK_SECRET")
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.drain_timeout = drain_timeout
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._max_in_flight = max_in_flight
+        self._tasks: set[asyncio.Task] = set()
+        self._draining = False
+        self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), self.secret.encode()):
+            return web.Response(status=401)
+        if self._draining:
+            return web.Response(status=503)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError as e:
+            return web.Response(status=400, text=f"Некорректный апдейт: {e}")
+        await self._slots.acquire()
+        if self._draining:  # остановка началась, пока ждали свободного места
+            self._slots.release()
+            return web.Response(status=503)
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            logging.exception(f"Ошибка обработки апдейта {update.update_id}")
+        finally:
+            self._slots.release()
+
+    async def start(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT, url: str = WEBHOOK_URL):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Webhook слушает http://{host}:{port}{WEBHOOK_PATH}")
+        if url:
+            await self.bot.set_webhook(url.rstrip("/") + WEBHOOK_PATH, secret_token=self.secret,
+                                       max_connections=min(self._max_in_flight, 100),
+                                       allowed_updates=self.dp.resolve_used_update_types())
+            logging.info(f"Webhook зарегистрирован в Telegram: {url}")
+
+    async def stop(self):
+        """Плавная остановка: не принимать новые апдейты и дождаться начатых."""
+        self._draining = True
+        if self._tasks:
+            logging.info(f"Webhook: ожидание {len(self._tasks)} начатых апдейтов...")
+            _, pending = await asyncio.wait(set(self._tasks), timeout=self.drain_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Принимать апдейты через webhook до SIGINT/SIGTERM."""
+    server = WebhookServer(dp, bot)
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    await server.start()
+    try:
+        await stopped.wait()
+    finally:
+        await server.stop()